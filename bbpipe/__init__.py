@@ -1,2 +1,2 @@
 from .stage import PipelineStage
-from .pipeline import Pipeline
+from .pipeline import Pipeline, NativePipeline
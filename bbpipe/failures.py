@@ -0,0 +1,52 @@
+import json
+import os
+
+
+class FailureManifest:
+    """
+    Keeps track of the stages, and of the items of fanned-out stages,
+    that failed in the last run of a pipeline, so that resuming it only
+    re-runs the work that failed.
+
+    For fanned-out stages, the manifest also stores the output files of
+    all the items, since the map output only lists those that succeeded.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.records = json.load(f)
+        else:
+            self.records = {}
+
+    def stage_failed(self, stage_name):
+        """Returns True if a whole stage failed"""
+        return self.records.get(stage_name, {}).get('failed', False)
+
+    def failed_items(self, stage_name):
+        """Return the indices of the failed items of a stage (if any)"""
+        return self.records.get(stage_name, {}).get('items', [])
+
+    def item_outputs(self, stage_name):
+        """Return the output files of all the items of a stage"""
+        return self.records[stage_name]['outputs']
+
+    def record_stage(self, stage_name):
+        self.records[stage_name] = {'failed': True}
+        self.save()
+
+    def record_items(self, stage_name, indices, item_outputs):
+        self.records[stage_name] = {'items': sorted(indices),
+                                    'outputs': item_outputs}
+        self.save()
+
+    def clear(self, stage_name):
+        if stage_name in self.records:
+            del self.records[stage_name]
+            self.save()
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(tmp_filename, self.filename)
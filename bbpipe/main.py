@@ -1,9 +1,8 @@
 import os
 import yaml
 import sys
-import parsl
 import argparse
-from . import Pipeline, PipelineStage
+from . import Pipeline, NativePipeline, PipelineStage
 from . import sites
 
 # Add the current dir to the path - often very useful
@@ -14,6 +13,26 @@ parser.add_argument('pipeline_config', help='Pipeline configuration file in YAML
 parser.add_argument('--export-cwl', type=str, help='Exports pipeline in CWL format to provided path and exits')
 parser.add_argument('--dry-run', action='store_true', help='Just print out the commands the pipeline would run without running them')
 
+def make_pipeline(pipe_config, stages):
+    """
+    Create the pipeline for the launcher chosen in the configuration
+    """
+    launcher = pipe_config.get("launcher", "local")
+    if launcher == "local":
+        launcher_config = sites.local.make_launcher(stages)
+    elif launcher == "cori":
+        launcher_config = sites.cori.make_launcher(stages)
+    elif launcher == "cori-interactive":
+        launcher_config = sites.cori_interactive.make_launcher(stages)
+    elif launcher == "native":
+        # Runs stages in local processes without parsl
+        launcher_config = sites.native.make_launcher(stages, pipe_config.get('max_cores'),
+                                                     pipe_config.get('persistent_workers', False))
+        return NativePipeline(launcher_config, stages)
+    else:
+        raise ValueError(f"Unknown launcher {launcher}")
+    return Pipeline(launcher_config, stages)
+
 def run(pipeline_config_filename, dry_run=False):
     """
     Runs the pipeline
@@ -24,7 +43,8 @@ def run(pipeline_config_filename, dry_run=False):
     # Optional logging of pipeline infrastructure to
     # file.
     log_file = pipe_config.get('pipeline_log')
-    if log_file:
+    if log_file and pipe_config.get("launcher", "local") != "native":
+        import parsl
         parsl.set_file_logger(log_file)
 
     # Required configuration information
@@ -34,37 +54,28 @@ def run(pipeline_config_filename, dry_run=False):
     # Python modules in which to search for pipeline stages
     modules = pipe_config['modules'].split()
 
-    # parsl execution/launcher configuration information
-    launcher = pipe_config.get("launcher", "local")
-    if launcher == "local":
-        launcher_config = sites.local.make_launcher(stages)
-    elif launcher == "cori":
-        launcher_config = sites.cori.make_launcher(stages)
-    elif launcher == "cori-interactive":
-        launcher_config = sites.cori_interactive.make_launcher(stages)
-    else:
-        raise ValueError(f"Unknown launcher {launcher}")
-    # 
-    # launcher_config = pipe_config['launcher']
-
     # Inputs and outputs
     output_dir = pipe_config['output_dir']
     inputs = pipe_config['inputs']
     log_dir = pipe_config['log_dir']
     resume = pipe_config['resume']
+    # When resuming, also compare the contents of input files whose
+    # size or modification time have changed
+    hash_content = pipe_config.get('resume_hash_content', False)
 
     stages_config = pipe_config['config']
 
     for module in modules:
         __import__(module)
 
-    # Create and run pipeline
-    pipeline = Pipeline(launcher_config, stages)
+    # Create and run pipeline, using the execution/launcher
+    # configuration information
+    pipeline = make_pipeline(pipe_config, stages)
 
     if dry_run:
-        pipeline.dry_run(inputs, output_dir, stages_config)
+        pipeline.dry_run(inputs, output_dir, stages_config, pipe_config.get('cost_model'))
     else:
-        pipeline.run(inputs, output_dir, log_dir, resume, stages_config)
+        pipeline.run(inputs, output_dir, log_dir, resume, stages_config, hash_content=hash_content)
 
 def export_cwl(args):
     """
@@ -87,17 +98,9 @@ def export_cwl(args):
     stages = config['stages']
 
     # Exports the pipeline itself
-    launcher = config.get("launcher", "local")
-    if launcher == "local":
-        launcher_config = sites.local.make_launcher(stages)
-    elif launcher == "cori":
-        launcher_config = sites.cori.make_launcher(stages)
-    else:
-        raise ValueError(f"Unknown launcher {launcher}")
-
     inputs = config['inputs']
 
-    pipeline = Pipeline(launcher_config, stages)
+    pipeline = make_pipeline(config, stages)
     cwl_wf = pipeline.generate_cwl(inputs)
     cwl_wf.export(f'{path}/pipeline.cwl')
 
@@ -0,0 +1,91 @@
+import os
+
+
+class ParallelHDFWriter:
+    """
+    Writes datasets whose rows are computed by different MPI processes
+    into a single HDF5 file.
+
+    All processes must create the same datasets (with their final shapes),
+    and then each process writes the rows it has computed. If h5py is
+    MPI-enabled, all processes write directly into the shared file.
+    Otherwise each process writes its rows to a file of its own, and these
+    are consolidated into the shared file by the root process when the
+    writer is closed. Without MPI (comm=None), rows are written directly.
+
+    The writer can be used as a context manager, and the file is complete
+    once it has been closed by all processes.
+    """
+    def __init__(self, filename, comm=None):
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            import h5py
+        self.filename = filename
+        self.comm = comm
+        self.rank = 0 if comm is None else comm.Get_rank()
+        self.size = 1 if comm is None else comm.Get_size()
+        self.datasets = {}
+
+        if (self.size > 1) and h5py.get_config().mpi:
+            self.part_filename = None
+            self.file = h5py.File(filename, 'w', driver='mpio', comm=comm)
+        elif self.size > 1:
+            self.part_filename = f'{filename}.part{self.rank}'
+            self.file = h5py.File(self.part_filename, 'w')
+        else:
+            self.part_filename = None
+            self.file = h5py.File(filename, 'w')
+
+    def create_dataset(self, name, shape, dtype='f8'):
+        """
+        Create a dataset with the given (total) shape.
+        This must be called by all processes with the same arguments.
+        """
+        self.datasets[name] = (tuple(shape), dtype)
+        if self.part_filename is None:
+            self.file.create_dataset(name, shape, dtype=dtype)
+        else:
+            self.file.create_group(name)
+
+    def write(self, name, start, data):
+        """
+        Write the rows [start, start+len(data)) of a dataset.
+        """
+        if self.part_filename is None:
+            self.file[name][start:start+len(data)] = data
+        else:
+            self.file[name].create_dataset(str(start), data=data)
+
+    def close(self):
+        self.file.close()
+        if self.part_filename is not None:
+            self.comm.Barrier()
+            if self.rank == 0:
+                self.consolidate()
+        if self.comm is not None:
+            self.comm.Barrier()
+
+    def consolidate(self):
+        """
+        Gather the rows written to the files of all processes into the
+        shared file, and remove the former.
+        """
+        import h5py
+        with h5py.File(self.filename, 'w') as f:
+            for name, (shape, dtype) in self.datasets.items():
+                f.create_dataset(name, shape, dtype=dtype)
+            for rank in range(self.size):
+                part_filename = f'{self.filename}.part{rank}'
+                with h5py.File(part_filename, 'r') as part:
+                    for name in part:
+                        for start, rows in part[name].items():
+                            start = int(start)
+                            f[name][start:start+len(rows)] = rows[...]
+                os.remove(part_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,24 +1,40 @@
-import parsl
-from parsl.data_provider.files import File
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from .stage import PipelineStage
+from .provenance import ProvenanceStore, stage_config
+from .failures import FailureManifest
+from .resources import write_run_report, reset_peak_rss
+import json
 import os
+import signal
+import subprocess
 import sys
+import time
 
 class StageExecutionConfig:
     def __init__(self, info):
         self.name = info['name']
         self.site = info['site']
         self.nprocess = info.get('nprocess', 1)
+        self.fan_out = info.get('fan_out', False)
+        # Failed runs are retried after retry_delay seconds,
+        # doubling the delay after each attempt
+        self.retries = info.get('retries', 0)
+        self.retry_delay = info.get('retry_delay', 10.)
 
 class Pipeline:
     def __init__(self, launcher_config, stages):
         self.stage_execution_config = {}
         self.stage_names = []
         self.mpi_command = launcher_config['mpi_command']
-        self.dfk = parsl.DataFlowKernel(launcher_config)
+        self.setup_executor(launcher_config)
         for info in stages:
             self.add_stage(info)
 
+    def setup_executor(self, launcher_config):
+        import parsl
+        self.dfk = parsl.DataFlowKernel(launcher_config)
+
     def add_stage(self, stage_info):
         sec = StageExecutionConfig(stage_info)
         self.stage_execution_config[sec.name] = sec
@@ -32,6 +48,7 @@ class Pipeline:
         return [f'{outdir}/{tag}.{ftype.suffix}' for tag,ftype in stage.outputs]
 
     def find_inputs(self, stage, data_elements):
+        from parsl.data_provider.files import File
         inputs = []
         for inp in stage.input_tags():
             item = data_elements[inp]
@@ -86,7 +103,73 @@ class Pipeline:
             raise ValueError(msg)
         return ordered_stages
 
-    def dry_run(self, overall_inputs, output_dir, stages_config):
+    def dependency_graph(self, stages):
+        """
+        Return a dictionary with, for each stage name, the set of
+        names of the stages that generate its inputs.
+        """
+        producers = {tag: stage.name for stage in stages for tag in stage.output_tags()}
+        return {stage.name: {producers[tag] for tag in stage.input_tags() if tag in producers}
+                for stage in stages}
+
+    def critical_path_lengths(self, stages, costs):
+        """
+        Return, for each stage, the total cost of the longest chain of
+        stages that starts with it. The stages must be in the order given
+        by ordered_stages, and `costs` is a dictionary with the cost of
+        each stage.
+        """
+        graph = self.dependency_graph(stages)
+        lengths = {}
+        for stage in reversed(stages):
+            downstream = [lengths[s.name] for s in stages if stage.name in graph[s.name]]
+            lengths[stage.name] = costs[stage.name] + max(downstream, default=0)
+        return lengths
+
+    def stage_costs(self, stages, provenance):
+        """
+        Estimate the cost of each stage from the time it took to run the
+        last time. Stages that have never been run are given the average
+        cost of the others.
+        """
+        walltimes = {stage.name: provenance.walltime(stage.name) for stage in stages}
+        known = [t for t in walltimes.values() if t is not None]
+        default = sum(known) / len(known) if known else 1.0
+        return {name: default if t is None else t for name, t in walltimes.items()}
+
+    def prioritized_stages(self, stages, costs):
+        """
+        Order the stages so that each one comes after the stages it depends
+        on, choosing at each step the stage with the longest critical path
+        (i.e. the longest chain of stages depending on it) among those
+        whose dependencies have been included.
+        """
+        graph = self.dependency_graph(stages)
+        lengths = self.critical_path_lengths(stages, costs)
+        remaining = stages[:]
+        prioritized = []
+        done = set()
+        while remaining:
+            ready = [s for s in remaining if graph[s.name] <= done]
+            stage = max(ready, key=lambda s: lengths[s.name])
+            prioritized.append(stage)
+            remaining.remove(stage)
+            done.add(stage.name)
+        return prioritized
+
+    def stage_outdated(self, stage, outputs, input_files, rerun_tags, provenance, stages_config):
+        """
+        Check whether a stage needs to be re-run when resuming a pipeline.
+        Returns None if it doesn't, or the reason why it does otherwise.
+        """
+        if not all(os.path.exists(output) for output in outputs):
+            return "some of its outputs are missing"
+        rerun_inputs = [tag for tag in input_files if tag in rerun_tags]
+        if rerun_inputs:
+            return f"its inputs {rerun_inputs} are being regenerated"
+        return provenance.check(stage, input_files, stages_config)
+
+    def dry_run(self, overall_inputs, output_dir, stages_config, cost_model=None):
         stages = self.ordered_stages(overall_inputs)
 
         for stage in stages:
@@ -95,7 +178,113 @@ class Pipeline:
             print(cmd)
             print()
 
-    def run(self, overall_inputs, output_dir, log_dir, resume, stages_config):
+        estimates = self.estimate_resources(stages, overall_inputs, output_dir,
+                                            stages_config, cost_model or {})
+        self.report_estimates(stages, estimates)
+
+    def estimate_resources(self, stages, overall_inputs, output_dir, stages_config, cost_model):
+        """
+        Estimate the resources needed by each stage from its cost model,
+        whose coefficients can be overridden for each stage in `cost_model`.
+        Returns a dictionary with the estimate for each stage (None for
+        stages without a cost model).
+        """
+        files = overall_inputs.copy()
+        for stage in stages:
+            files.update(zip(stage.output_tags(), self.find_outputs(stage, output_dir)))
+
+        estimates = {}
+        for stage in stages:
+            coefficients = dict(stage.cost_coefficients)
+            coefficients.update(cost_model.get(stage.name, {}))
+            config = stage_config(stage, stages_config)
+            estimates[stage.name] = stage.estimate_resources(config, files, coefficients)
+        return estimates
+
+    def report_estimates(self, stages, estimates):
+        """
+        Print the estimated resources of each stage, the nprocess, nodes,
+        walltime (in minutes) and partition suggested for running it with
+        the cori launcher, and the resulting length of the pipeline.
+        """
+        from .sites.cori import suggest_resources
+
+        if all(estimate is None for estimate in estimates.values()):
+            return
+        print("Estimated resources, and suggested settings for the cori launcher:")
+        print(f"{'Stage':24s} {'CPU time (h)':>12s} {'Memory (GB)':>11s} {'nprocess':>8s} "
+              f"{'nodes':>5s} {'walltime':>8s} {'partition':>9s}")
+        walltimes = {}
+        for stage in stages:
+            estimate = estimates[stage.name]
+            walltimes[stage.name] = 0
+            if estimate is None:
+                print(f"{stage.name:24s} (no cost model)")
+                continue
+            cores_per_process = estimate.get('cores_per_process', 1)
+            line = (f"{stage.name:24s} {estimate['cpu_time'] / 3600:12.2f} "
+                    f"{estimate['memory'] / 1024**3:11.2f}")
+            try:
+                s = suggest_resources(estimate['cpu_time'], estimate['memory'],
+                                      estimate['max_nprocess'], cores_per_process)
+            except ValueError as error:
+                print(f"{line} {error}")
+                continue
+            print(f"{line} {s['nprocess']:8d} {s['nodes']:5d} {s['walltime']:8d} "
+                  f"{s['partition']:>9s}")
+            walltimes[stage.name] = estimate['cpu_time'] / (s['nprocess'] * cores_per_process)
+
+        lengths = self.critical_path_lengths(stages, walltimes)
+        print(f"Estimated time to run the pipeline with these settings: "
+              f"{max(lengths.values(), default=0) / 60:.1f} minutes "
+              "(excluding stages without a cost model)")
+
+    def plan_stages(self, stages, overall_inputs, output_dir, resume, provenance, failures,
+                    stages_config):
+        """
+        Work out the input and output files of each stage, and whether
+        it needs to be run. Returns a list of (stage, outputs, input_files,
+        run, redo_items) tuples, in the same order as `stages`, where
+        `redo_items` lists the items of a fanned-out stage that failed
+        in the previous run, if only those need to be re-run.
+        """
+        if resume:
+            print("Since parameter 'resume' is True we will skip steps that are up to date")
+
+        # Paths to all files, and tags of files that will be regenerated
+        file_paths = overall_inputs.copy()
+        rerun_tags = set()
+        plan = []
+
+        for stage in stages:
+            outputs = self.find_outputs(stage, output_dir)
+            input_files = {tag: file_paths[tag] for tag in stage.input_tags()}
+            file_paths.update(zip(stage.output_tags(), outputs))
+            # If we are in "resume" mode we re-use any existing outputs, as long
+            # as the stage's inputs, configuration and code haven't changed since
+            # they were generated, and the stage didn't fail.
+            run = True
+            redo_items = None
+            if resume:
+                reason = self.stage_outdated(stage, outputs, input_files, rerun_tags,
+                                             provenance, stages_config)
+                if (reason is None) and failures.stage_failed(stage.name):
+                    reason = "it failed in the previous run"
+                if reason is None and failures.failed_items(stage.name):
+                    redo_items = failures.failed_items(stage.name)
+                    print(f"Re-running {len(redo_items)} items of stage {stage.name} "
+                          "that failed in the previous run")
+                elif reason is None:
+                    print(f"Skipping stage {stage.name} because it is up to date")
+                    run = False
+                else:
+                    print(f"Re-running stage {stage.name} because {reason}")
+            if run:
+                rerun_tags.update(stage.output_tags())
+            plan.append((stage, outputs, input_files, run, redo_items))
+        return plan
+
+    def run(self, overall_inputs, output_dir, log_dir, resume, stages_config, hash_content=False):
         stages = self.ordered_stages(overall_inputs)
         data_elements = overall_inputs.copy()
         futures = []
@@ -103,45 +292,147 @@ class Pipeline:
         os.makedirs(output_dir, exist_ok=True)
         os.makedirs(log_dir, exist_ok=True)
 
-        if resume:
-            print("Since parameter 'resume' is True we will skip steps whose outputs exist already")
+        # Inputs, configuration and code used to generate each stage's outputs
+        provenance = ProvenanceStore(f'{output_dir}/provenance.json', hash_content)
+        # Stages that failed in previous runs
+        failures = FailureManifest(f'{log_dir}/failures.json')
+        # Queue stages on the critical path first, so that they are picked
+        # up first by parsl when several stages are ready to run
+        stages = self.prioritized_stages(stages, self.stage_costs(stages, provenance))
+        plan = self.plan_stages(stages, overall_inputs, output_dir, resume,
+                                provenance, failures, stages_config)
 
-        for stage in stages:
-            sec = self.stage_execution_config[stage.name]
-            app = stage.generate(self.dfk, sec.nprocess, sec.site, log_dir, mpi_command=self.mpi_command)
-            inputs = self.find_inputs(stage, data_elements)
-            outputs = self.find_outputs(stage, output_dir)
-            # All pipeline stages implicitly get the overall configuration file
-            inputs.append(File(stages_config))
-            already_run_stage = all(os.path.exists(output) for output in outputs)
-            # If we are in "resume" mode and the pipeline has already been run
-            # then we re-use any existing outputs.  User is responsible for making
-            # sure they are complete!
-            if resume and already_run_stage:
-                print(f"Skipping stage {stage.name} because its outputs exist already")
-                for (tag,_),filename in zip(stage.outputs, outputs):
+        for stage, outputs, input_files, run, redo_items in plan:
+            if not run:
+                for tag, filename in zip(stage.output_tags(), outputs):
                     data_elements[tag] = filename
+                continue
             # Otherwise, run the pipeline and register any outputs from the
             # pipe element as a "future" - a file that the pipeline will
             # create later
-            else:
-                print(f"Pipeline queuing stage {stage.name} with {sec.nprocess} processes")
-                future = app(inputs=inputs, outputs=outputs)
-                future._bbpipe_name = stage.name
-                futures.append(future)
-                for i, output in enumerate(stage.output_tags()):
-                    data_elements[output] = future.outputs[i]
-
-        # Wait for the final results, from all files
+            from parsl.data_provider.files import File
+            sec = self.stage_execution_config[stage.name]
+            if sec.fan_out or redo_items:
+                print(f"Stage {stage.name} can only be fanned out by the native launcher. "
+                      "Running it as a single task.")
+            app = stage.generate(self.dfk, sec.nprocess, sec.site, log_dir, mpi_command=self.mpi_command,
+                                 retries=sec.retries, retry_delay=sec.retry_delay)
+            inputs = self.find_inputs(stage, data_elements)
+            # All pipeline stages implicitly get the overall configuration file
+            inputs.append(File(stages_config))
+            print(f"Pipeline queuing stage {stage.name} with {sec.nprocess} processes")
+            self.clear_resources(stage.name, log_dir)
+            future = app(inputs=inputs, outputs=outputs)
+            future._bbpipe_name = stage.name
+            future._bbpipe_stage = stage
+            future._bbpipe_input_files = input_files
+            futures.append(future)
+            for i, output in enumerate(stage.output_tags()):
+                data_elements[output] = future.outputs[i]
+
+        # Wait for the final results, from all files. Stages that don't
+        # depend on a failed stage carry on running.
+        import parsl.app.errors
+        completed = []
+        failed = False
         for future in futures:
             try:
                 future.result()
             except parsl.app.errors.AppFailure:
-                stdout_file = f'{log_dir}/{future._bbpipe_name}.err'
-                stderr_file = f'{log_dir}/{future._bbpipe_name}.out'
-                sys.stderr.write(f"""
+                self.report_failure(future._bbpipe_name, log_dir)
+                failures.record_stage(future._bbpipe_name)
+                failed = True
+                continue
+            except Exception:
+                print(f"Stage {future._bbpipe_name} was not run because a stage it depends on failed")
+                failures.record_stage(future._bbpipe_name)
+                failed = True
+                continue
+            provenance.record(future._bbpipe_stage, future._bbpipe_input_files, stages_config)
+            failures.clear(future._bbpipe_name)
+            completed.append(future._bbpipe_name)
+
+        self.report_resources(completed, log_dir)
+        if failed:
+            return None
+
+        # Return a dictionary of the resulting file outputs
+        return data_elements
+
+    def resources_file(self, stage_name, log_dir):
+        return f'{log_dir}/{stage_name}.resources.json'
+
+    def clear_resources(self, stage_name, log_dir):
+        """
+        Remove the resources recorded by a previous run of a stage
+        """
+        filename = self.resources_file(stage_name, log_dir)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def report_resources(self, stage_names, log_dir):
+        """
+        Collect the resources used by each of the stages that were run
+        into the run_report.json and run_report.csv files in the log
+        directory, and print a summary.
+        """
+        records = []
+        for stage_name in stage_names:
+            filename = self.resources_file(stage_name, log_dir)
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    records.append(json.load(f))
+        if not records:
+            return
+        summaries = write_run_report(f'{log_dir}/run_report', records)
+
+        # The item tasks of fanned-out stages are summarized in a single line
+        rows = []
+        items = {}
+        for r in summaries:
+            if (r['map_index'] is None) or (r['map_index'] < 0):
+                rows.append((r['stage'], r['nprocess'], r['walltime'],
+                             r['cpu_time'], r['max_rss']))
+            else:
+                items.setdefault(r['stage'], []).append(r)
+        for stage_name, rs in items.items():
+            rows.append((f"{stage_name}[{len(rs)} items]",
+                         max(r['nprocess'] for r in rs),
+                         sum(r['walltime'] for r in rs),
+                         sum(r['cpu_time'] for r in rs),
+                         max(r['max_rss'] for r in rs)))
+
+        print(f"Resources used by each stage (also in {log_dir}/run_report.csv):")
+        print(f"{'Stage':32s} {'Processes':>9s} {'Wall time (s)':>13s} "
+              f"{'CPU time (s)':>12s} {'Max RSS (MB)':>12s}")
+        for name, nprocess, walltime, cpu_time, max_rss in rows:
+            print(f"{name:32s} {nprocess:9d} {walltime:13.1f} "
+                  f"{cpu_time:12.1f} {max_rss / 2**20:12.1f}")
+
+    def gather_map_output(self, stage, map_output, item_outputs, failed_items):
+        """
+        Write the map output file of a fanned-out stage, listing the
+        outputs of all the items of its map input that didn't fail, and
+        check that they exist. Returns None if so, or what is wrong otherwise.
+        """
+        filenames = [f for i, f in enumerate(item_outputs) if i not in failed_items]
+        missing = [f for f in filenames if not os.path.exists(f)]
+        if missing:
+            return f"{len(missing)} item outputs are missing, e.g. {missing[0]}"
+        with open(map_output, 'w') as f:
+            for fname in filenames:
+                f.write(fname+"\n")
+        return None
+
+    def report_failure(self, stage_name, log_dir):
+        """
+        Print the output and error logs of a stage that failed
+        """
+        stdout_file = f'{log_dir}/{stage_name}.out'
+        stderr_file = f'{log_dir}/{stage_name}.err'
+        sys.stderr.write(f"""
 *************************************************
-Error running pipeline stage {future._bbpipe_name}.
+Error running pipeline stage {stage_name}.
 
 Standard output and error streams below.
 
@@ -151,12 +442,12 @@ Standard output:
 ----------------
 
 """)
-                if os.path.exists(stdout_file):
-                    sys.stderr.write(open(stdout_file).read())
-                else:
-                    sys.stderr.write("STDOUT MISSING!\n\n")
+        if os.path.exists(stdout_file):
+            sys.stderr.write(open(stdout_file).read())
+        else:
+            sys.stderr.write("STDOUT MISSING!\n\n")
 
-                sys.stderr.write(f"""
+        sys.stderr.write(f"""
 *************************************************
 
 Standard error:
@@ -164,16 +455,10 @@ Standard error:
 
 """)
 
-
-                if os.path.exists(stderr_file):
-                    sys.stderr.write(open(stderr_file).read())
-                else:
-                    sys.stderr.write("STDERR MISSING!\n\n")
-                
-                return None
-
-        # Return a dictionary of the resulting file outputs
-        return data_elements
+        if os.path.exists(stderr_file):
+            sys.stderr.write(open(stderr_file).read())
+        else:
+            sys.stderr.write("STDERR MISSING!\n\n")
 
     def generate_cwl(self, overall_inputs):
         """
@@ -257,3 +542,492 @@ Standard error:
             wf.outputs.append(cwl_out)
 
         return wf
+
+
+def write_pid(pid_file):
+    """
+    Record the process running a task, so that the pipeline can find
+    out what happened to it if the process dies
+    """
+    if pid_file is not None:
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+
+
+def run_command(cmd, stdout_file, stderr_file, append=False, pid_file=None):
+    """
+    Run a stage command line, sending its output streams to the given
+    log files (appending to them if `append` is True, e.g. when retrying
+    a command). Returns the exit status of the command.
+    """
+    write_pid(pid_file)
+    mode = 'a' if append else 'w'
+    with open(stdout_file, mode) as stdout, open(stderr_file, mode) as stderr:
+        return subprocess.call(cmd, shell=True, stdout=stdout, stderr=stderr)
+
+
+def preload_modules(modules):
+    """
+    Initialize a persistent worker, importing the modules
+    where the pipeline stages are defined
+    """
+    for module in modules:
+        __import__(module)
+
+
+def pool_processes(executor):
+    """
+    Return the worker processes of a ProcessPoolExecutor by pid, from
+    which the exit codes of those that died can be read. There is no
+    public API for this, so this relies on the executor's private
+    `_processes` (which it clears when shut down, so this must be called
+    before that), and returns an empty dictionary if it isn't available.
+    """
+    return dict(getattr(executor, '_processes', None) or {})
+
+
+def run_in_worker(args, stdout_file, stderr_file, append=False, pid_file=None):
+    """
+    Run a (single-process) stage within this persistent worker, as the
+    stage's command line would, sending its output streams to the given
+    log files. Returns the exit status the command would have had.
+    If the stage crashes the worker (e.g. with a segmentation fault in
+    compiled code), its traceback is written to the error log.
+    """
+    import faulthandler
+    import traceback
+    write_pid(pid_file)
+    mode = 'a' if append else 'w'
+    argv = sys.argv
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(stdout_file, mode) as stdout, open(stderr_file, mode) as stderr:
+        # Redirect the file descriptors themselves, so that the output
+        # of compiled libraries also ends up in the logs
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        faulthandler.enable(file=sys.__stderr__)
+        try:
+            sys.argv = ['python3'] + args
+            stage = PipelineStage.get_stage(args[0])
+            reset_peak_rss()
+            stage.execute(stage._parse_command_line())
+            status = 0
+        except SystemExit as error:
+            if isinstance(error.code, int) or error.code is None:
+                status = error.code or 0
+            else:
+                print(error.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            sys.argv = argv
+    return status
+
+
+class NativePipeline(Pipeline):
+    """
+    A pipeline that runs its stages in a pool of local processes,
+    without going through parsl.
+
+    Stages are launched as soon as all the stages they depend on have
+    finished, as long as the total number of processes used by the stages
+    running at the same time does not exceed the `max_cores` of the
+    launcher. Stages using more processes than that are run on their own.
+    When several stages are ready, those on the critical path (with the
+    longest chain of stages depending on them, as estimated from previous
+    runs) are launched first.
+
+    Stages with a map input and `fan_out: True` are split into tasks: a
+    main task (--map_index=-1) is run first, followed by a separate task
+    for each item of the map input (--map_index=i), with its own logs in
+    {log_dir}/{stage}_item{i}.out/.err. The stage is finished once all its
+    tasks have finished, and its map output then lists the outputs of all
+    the items that succeeded.
+
+    With `persistent_workers`, the processes of the pool import the
+    modules where the stages are defined once, and then run single-process
+    tasks within themselves instead of launching a new python process for
+    each of them (MPI tasks are still launched with their command line).
+
+    Failed tasks are retried up to `retries` times. Items that still fail
+    are skipped, and stages that fail only stop the stages that depend
+    on them. Failures are recorded in {log_dir}/failures.json, so that
+    resuming the pipeline only re-runs the failed stages and items.
+    If a process of the pool dies while running a task (e.g. killed by a
+    signal), the task fails with the status a command killed by that
+    signal would have (e.g. -11 for a segmentation fault), and the pool
+    is replaced. Other tasks that were running in the pool are run again.
+    """
+    def setup_executor(self, launcher_config):
+        self.max_cores = launcher_config['max_cores']
+        self.persistent_workers = launcher_config.get('persistent_workers', False)
+
+    def make_executor(self, stages):
+        if not self.persistent_workers:
+            return ProcessPoolExecutor(self.max_cores)
+        modules = sorted({stage.get_module() for stage in stages})
+        return ProcessPoolExecutor(self.max_cores, initializer=preload_modules,
+                                   initargs=(modules,))
+
+    def pid_file(self, name, log_dir):
+        return f'{log_dir}/{name}.pid'
+
+    def task_status(self, future, name, log_dir):
+        """
+        Exit status of a task that has finished normally
+        """
+        pid_file = self.pid_file(name, log_dir)
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+        try:
+            return future.result()
+        except Exception as error:
+            # e.g. the arguments of the task couldn't be sent to the pool
+            with open(f'{log_dir}/{name}.err', 'a') as f:
+                f.write(f"Task {name} could not be run: {error!r}\n")
+            return 1
+
+    def lost_task_statuses(self, names, log_dir, processes):
+        """
+        Exit status of the tasks that were running in a process pool that
+        broke because one of its processes died, from the exit code of
+        the process that ran each of them (see pool_processes). Returns
+        None for the tasks that hadn't started, and for those whose process
+        was terminated by the pool because another process died, so that
+        they can be run again. Tasks whose process can't be found fail with
+        status 1.
+        """
+        exit_codes = {}
+        for name in names:
+            pid_file = self.pid_file(name, log_dir)
+            if not os.path.exists(pid_file):
+                continue
+            with open(pid_file) as f:
+                pid = int(f.read())
+            os.remove(pid_file)
+            process = processes.get(pid)
+            if process is not None:
+                process.join()
+                exit_codes[name] = process.exitcode
+            else:
+                exit_codes[name] = None
+
+        # Processes terminated by the pool are only collateral damage if
+        # some other process died first
+        terminated = -signal.SIGTERM
+        culprit = any(code not in (None, terminated) for code in exit_codes.values())
+        statuses = {}
+        for name in names:
+            if name not in exit_codes:
+                statuses[name] = None
+                continue
+            code = exit_codes[name]
+            if culprit and code == terminated:
+                statuses[name] = None
+                continue
+            # Workers don't exit by themselves while running a task
+            statuses[name] = code if code else 1
+            if code is None:
+                message = "died"
+            elif code < 0:
+                message = f"killed by signal {signal.Signals(-code).name}"
+            else:
+                message = f"exited with status {code}"
+            with open(f'{log_dir}/{name}.err', 'a') as f:
+                f.write(f"Pipeline worker process running task {name} {message}\n")
+        return statuses
+
+    def task_name(self, stage, map_index):
+        if (map_index is None) or (map_index < 0):
+            return stage.name
+        return f'{stage.name}_item{map_index}'
+
+    def run(self, overall_inputs, output_dir, log_dir, resume, stages_config, hash_content=False):
+        stages = self.ordered_stages(overall_inputs)
+        graph = self.dependency_graph(stages)
+        for stage in stages:
+            if self.stage_execution_config[stage.name].fan_out and stage.map_input is None:
+                raise ValueError(f"Stage {stage.name} can't be fanned out as it has no map input")
+
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(log_dir, exist_ok=True)
+
+        provenance = ProvenanceStore(f'{output_dir}/provenance.json', hash_content)
+        failures = FailureManifest(f'{log_dir}/failures.json')
+        costs = self.stage_costs(stages, provenance)
+        priority = self.critical_path_lengths(stages, costs)
+        plan = self.plan_stages(stages, overall_inputs, output_dir, resume,
+                                provenance, failures, stages_config)
+
+        file_paths = overall_inputs.copy()
+        for stage, outputs, _, _, _ in plan:
+            file_paths.update(zip(stage.output_tags(), outputs))
+
+        # For each fanned-out stage, the outputs of all its items, the
+        # number of items still to be run, and the items that failed
+        item_outputs = {}
+        items_left = {}
+        failed_items = {}
+
+        # Tasks still to be launched, by decreasing priority, as
+        # (stage, input_files, map_index), and stages that haven't
+        # finished yet. Stages that are fanned out start with their
+        # main task, and their item tasks are added when it finishes.
+        waiting = []
+        redo_stages = set()
+        for stage, _, input_files, run, redo_items in plan:
+            if not run:
+                continue
+            sec = self.stage_execution_config[stage.name]
+            if redo_items and sec.fan_out:
+                # Only re-run the items that failed last time
+                redo_stages.add(stage.name)
+                item_outputs[stage.name] = failures.item_outputs(stage.name)
+                items_left[stage.name] = len(redo_items)
+                failed_items[stage.name] = set()
+                waiting += [(stage, input_files, i) for i in redo_items]
+            elif sec.fan_out:
+                waiting.append((stage, input_files, -1))
+            else:
+                waiting.append((stage, input_files, None))
+        waiting.sort(key=lambda x: -priority[x[0].name])
+        unfinished = {stage.name for stage, _, _ in waiting}
+        failed_stages = set()
+
+        # Number of times each task has failed, and when it can be retried
+        attempts = {}
+        not_before = {}
+
+        stage_start = {}
+        running = {}
+        timings = []
+        completed = []
+        cores_free = self.max_cores
+
+        def finish_stage(stage, input_files):
+            walltime = time.time() - stage_start[stage.name]
+            print(f"Pipeline finished stage {stage.name} in {walltime:.1f} s")
+            unfinished.remove(stage.name)
+            # Re-running failed items doesn't tell us how long the stage takes
+            if stage.name in redo_stages:
+                walltime = None
+            provenance.record(stage, input_files, stages_config, walltime=walltime)
+            if not failed_items.get(stage.name):
+                failures.clear(stage.name)
+
+        def fail_stage(stage_name):
+            # Stages depending on a failed stage can't be run either
+            failed_stages.add(stage_name)
+            failures.record_stage(stage_name)
+            for other in [t[0] for t in waiting if stage_name in graph[t[0].name]]:
+                if other.name not in failed_stages:
+                    print(f"Skipping stage {other.name} because stage {stage_name} failed")
+                    waiting[:] = [t for t in waiting if t[0] is not other]
+                    fail_stage(other.name)
+
+        def item_done(stage, input_files):
+            items_left[stage.name] -= 1
+            if items_left[stage.name] > 0:
+                return
+            # Gather the outputs of all the items that didn't fail
+            problem = self.gather_map_output(stage, file_paths[stage.map_output],
+                                             item_outputs[stage.name],
+                                             failed_items[stage.name])
+            if problem is not None:
+                sys.stderr.write(f"Error gathering the outputs of stage {stage.name}: {problem}\n")
+                fail_stage(stage.name)
+                return
+            if failed_items[stage.name]:
+                failures.record_items(stage.name, failed_items[stage.name],
+                                      item_outputs[stage.name])
+            finish_stage(stage, input_files)
+
+        start_time = time.time()
+        executor = self.make_executor(stages)
+        broken = False
+        try:
+            while waiting or running:
+                # Launch all the tasks whose stage dependencies have finished,
+                # that fit in the cores that are not being used and that
+                # aren't waiting to be retried
+                now = time.time()
+                for task in waiting[:]:
+                    stage, input_files, map_index = task
+                    if graph[stage.name] & unfinished:
+                        continue
+                    name = self.task_name(stage, map_index)
+                    if not_before.get(name, 0) > now:
+                        continue
+                    nprocess = self.stage_execution_config[stage.name].nprocess
+                    if running and nprocess > cores_free:
+                        continue
+                    resources = self.resources_file(name, log_dir)
+                    self.clear_resources(name, log_dir)
+                    if stage.name not in stage_start:
+                        print(f"Pipeline launching stage {stage.name} with {nprocess} processes")
+                        stage_start[stage.name] = time.time()
+                    logs = (f'{log_dir}/{name}.out', f'{log_dir}/{name}.err', name in attempts,
+                            self.pid_file(name, log_dir))
+                    try:
+                        if self.persistent_workers and nprocess == 1:
+                            args = stage.generate_args(file_paths, stages_config, output_dir,
+                                                       resources=resources, map_index=map_index)
+                            future = executor.submit(run_in_worker, args, *logs)
+                        else:
+                            cmd = stage.generate_command(file_paths, stages_config, output_dir,
+                                                         nprocess, self.mpi_command,
+                                                         resources=resources, map_index=map_index)
+                            future = executor.submit(run_command, cmd, *logs)
+                    except BrokenProcessPool:
+                        # A process died since the last tasks finished
+                        broken = True
+                        break
+                    running[future] = (task, nprocess, time.time())
+                    cores_free -= nprocess
+                    waiting.remove(task)
+
+                # Wake up when the next task can be retried
+                retry_times = [not_before[self.task_name(s, i)] for s, _, i in waiting
+                               if self.task_name(s, i) in not_before]
+                timeout = max(min(retry_times) - time.time(), 0) if retry_times else None
+                if broken and not running:
+                    executor.shutdown()
+                    executor = self.make_executor(stages)
+                    broken = False
+                    continue
+                if not running:
+                    if timeout is None:
+                        break
+                    time.sleep(timeout)
+                    continue
+
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                lost = {}
+                if broken or any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                    # A process of the pool died, so all the tasks running
+                    # in the pool are lost. Find out what happened to each
+                    # of them, and start a new pool.
+                    processes = pool_processes(executor)
+                    executor.shutdown(wait=True)
+                    done = set(running)
+                    names = [self.task_name(t[0][0], t[0][2]) for t in running.values()]
+                    lost = self.lost_task_statuses(names, log_dir, processes)
+                    print("A process of the pipeline pool died, restarting the pool")
+                    executor = self.make_executor(stages)
+                    broken = False
+
+                for future in done:
+                    task, nprocess, task_start = running.pop(future)
+                    stage, input_files, map_index = task
+                    name = self.task_name(stage, map_index)
+                    timings.append((nprocess, task_start, time.time()))
+                    cores_free += nprocess
+
+                    if name in lost:
+                        status = lost[name]
+                    else:
+                        status = self.task_status(future, name, log_dir)
+                    if status is None:
+                        # Lost because of another task, run it again
+                        waiting.append(task)
+                        waiting.sort(key=lambda x: -priority[x[0].name])
+                        continue
+
+                    if status != 0:
+                        sec = self.stage_execution_config[stage.name]
+                        attempts[name] = attempts.get(name, 0) + 1
+                        if attempts[name] <= sec.retries:
+                            delay = sec.retry_delay * 2**(attempts[name] - 1)
+                            print(f"Task {name} failed, retrying in {delay:g} s "
+                                  f"(attempt {attempts[name] + 1} of {sec.retries + 1})")
+                            not_before[name] = time.time() + delay
+                            waiting.append(task)
+                            waiting.sort(key=lambda x: -priority[x[0].name])
+                            continue
+                        self.report_failure(name, log_dir)
+                        if (map_index is not None) and (map_index >= 0):
+                            # Failed items are skipped without stopping the others
+                            failed_items[stage.name].add(map_index)
+                            item_done(stage, input_files)
+                        else:
+                            fail_stage(stage.name)
+                        continue
+
+                    completed.append(name)
+                    if map_index is None:
+                        finish_stage(stage, input_files)
+                    elif map_index < 0:
+                        # Fan out the items of the map input
+                        items = stage.read_map_items(file_paths[stage.map_input])
+                        outputs = stage.read_map_items(file_paths[stage.map_output])
+                        if len(outputs) != len(items):
+                            sys.stderr.write(f"Stage {stage.name} lists {len(outputs)} outputs "
+                                             f"for {len(items)} items\n")
+                            fail_stage(stage.name)
+                            continue
+                        print(f"Pipeline fanning out stage {stage.name} over {len(items)} items")
+                        item_outputs[stage.name] = outputs
+                        failed_items[stage.name] = set()
+                        waiting += [(stage, input_files, i) for i in range(len(items))]
+                        waiting.sort(key=lambda x: -priority[x[0].name])
+                        # Counting the main task as an item, so that stages
+                        # with no items are gathered here
+                        items_left[stage.name] = len(items) + 1
+                        item_done(stage, input_files)
+                    else:
+                        item_done(stage, input_files)
+        finally:
+            executor.shutdown()
+
+        self.report_parallelism(timings, start_time, time.time())
+        self.report_resources(completed, log_dir)
+
+        for stage_name, items in failed_items.items():
+            if items:
+                print(f"{len(items)} of {len(item_outputs[stage_name])} items of stage "
+                      f"{stage_name} failed: {sorted(items)}. "
+                      "Resume the pipeline to re-run them.")
+        if failed_stages:
+            print(f"Stages {sorted(failed_stages)} failed or were not run. "
+                  "Resume the pipeline to re-run them.")
+            return None
+
+        # Return a dictionary of the resulting file outputs
+        return file_paths
+
+    def report_parallelism(self, timings, start, end):
+        """
+        Print how many tasks (stages or their map tasks) and cores were
+        in use while the pipeline ran, from the (nprocess, start, end)
+        of each task.
+        """
+        span = end - start
+        if not timings or span <= 0:
+            return
+        # Number of stages and cores in use after each start or end
+        events = sorted([(t0, 1, n) for n, t0, t1 in timings] +
+                        [(t1, -1, -n) for n, t0, t1 in timings])
+        n_running = n_cores = max_running = 0
+        idle = events[0][0] - start
+        for (t, d_running, d_cores), (t_next, _, _) in zip(events, events[1:] + [(end, 0, 0)]):
+            n_running += d_running
+            n_cores += d_cores
+            max_running = max(max_running, n_running)
+            if n_running == 0:
+                idle += t_next - t
+        task_time = sum(t1 - t0 for n, t0, t1 in timings)
+        core_time = sum(n * (t1 - t0) for n, t0, t1 in timings)
+        print(f"Pipeline ran {len(timings)} tasks in {span:.1f} s")
+        print(f"Average number of tasks running: {task_time / span:.2f} (maximum {max_running})")
+        print(f"Average number of cores in use: {core_time / span:.2f} out of {self.max_cores}")
+        print(f"Time with no task running: {idle:.1f} s")
@@ -0,0 +1,52 @@
+import queue
+import threading
+
+# Marks the end of the items of a prefetched iterator
+_END = object()
+
+
+def prefetch_iterator(iterable, depth=1):
+    """
+    Iterate through `iterable` while a background thread fetches up to
+    `depth` items ahead, so that fetching the next item (e.g. reading a
+    chunk of data from a file) overlaps with processing the current one.
+
+    Exceptions raised while fetching an item are re-raised when that item
+    is reached. If the loop is left early, the background thread stops
+    after fetching the item it is working on.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for a free slot, unless the loop has been left
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as error:
+            put((None, error))
+
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import pathlib
+import yaml
+
+
+def hash_bytes(path):
+    """
+    Return the SHA1 hash of the contents of a file.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_object(obj):
+    """
+    Return the SHA1 hash of a JSON-serializable object.
+    """
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+_code_hashes = {}
+def hash_stage_code(stage):
+    """
+    Return a hash of the code of a pipeline stage.
+    Stages often rely on other modules in their package, so we hash
+    all the python files in the directory where the stage is defined.
+    """
+    directory = pathlib.Path(stage.get_executable()).parent
+    if directory not in _code_hashes:
+        h = hashlib.sha1()
+        for fname in sorted(directory.glob('*.py')):
+            h.update(fname.name.encode())
+            h.update(hash_bytes(fname).encode())
+        _code_hashes[directory] = h.hexdigest()
+    return _code_hashes[directory]
+
+
+def stage_config(stage, config_filename):
+    """
+    Return the configuration of a stage as resolved from its defaults
+    and the global and stage-specific sections of the configuration file.
+    """
+    with open(config_filename) as f:
+        overall_config = yaml.safe_load(f) or {}
+    config = {x: v for x, v in stage.config_options.items()
+              if type(v) is not type}
+    config.update(overall_config.get('global', {}))
+    config.update(overall_config.get(stage.name, {}))
+    return config
+
+
+class ProvenanceStore:
+    """
+    Keeps track of the inputs, configuration and code used to produce the
+    outputs of each pipeline stage, so that stages can be skipped when
+    resuming a pipeline only if none of these have changed.
+
+    Input files are checked through their size and modification time.
+    If `hash_content` is True, files whose size or modification time have
+    changed are also compared through a hash of their contents (which is
+    only computed in that case, or when recording a stage).
+    """
+    def __init__(self, filename, hash_content=False):
+        self.filename = filename
+        self.hash_content = hash_content
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.records = json.load(f)
+        else:
+            self.records = {}
+
+    def file_state(self, path, content=False):
+        st = os.stat(path)
+        state = {'path': str(path), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+        if content and os.path.isfile(path):
+            state['sha1'] = hash_bytes(path)
+        return state
+
+    def file_matches(self, path, record):
+        if not os.path.exists(path):
+            return False
+        state = self.file_state(path)
+        if state['path'] != record['path']:
+            return False
+        if (state['size'] == record['size']) and (state['mtime'] == record['mtime']):
+            return True
+        if self.hash_content and ('sha1' in record) and os.path.isfile(path):
+            return hash_bytes(path) == record['sha1']
+        return False
+
+    def check(self, stage, input_files, config_filename):
+        """
+        Check whether a stage's previous outputs are still valid.
+        Returns None if they are, or the reason why they aren't otherwise.
+        """
+        record = self.records.get(stage.name)
+        if record is None:
+            return "no provenance has been recorded for it"
+        if record['code'] != hash_stage_code(stage):
+            return "its code has changed"
+        if record['config'] != hash_object(stage_config(stage, config_filename)):
+            return "its configuration has changed"
+        if set(record['inputs'].keys()) != set(input_files.keys()):
+            return "its inputs have changed"
+        for tag, path in input_files.items():
+            if not self.file_matches(path, record['inputs'][tag]):
+                return f"input {tag} has changed"
+        return None
+
+    def record(self, stage, input_files, config_filename, walltime=None):
+        """
+        Record the provenance of a stage that has just been run,
+        and optionally the time it took to run (otherwise the time
+        recorded for a previous run is kept).
+        """
+        if walltime is None:
+            walltime = self.walltime(stage.name)
+        self.records[stage.name] = {
+            'code': hash_stage_code(stage),
+            'config': hash_object(stage_config(stage, config_filename)),
+            'inputs': {tag: self.file_state(path, content=self.hash_content)
+                       for tag, path in input_files.items()},
+        }
+        if walltime is not None:
+            self.records[stage.name]['walltime'] = walltime
+        self.save()
+
+    def walltime(self, stage_name):
+        """
+        Return the time taken by the last run of a stage, if known.
+        """
+        return self.records.get(stage_name, {}).get('walltime')
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(tmp_filename, self.filename)
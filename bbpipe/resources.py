@@ -0,0 +1,126 @@
+import csv
+import json
+import resource
+import time
+
+
+def io_counters():
+    """
+    Return the number of bytes read and written by this process so far
+    (including reads served from the page cache), or (None, None) if these
+    aren't available (they are only on Linux).
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return None, None
+    return counters.get('rchar'), counters.get('wchar')
+
+
+def reset_peak_rss():
+    """
+    Reset the peak memory usage of this process, so that processes
+    running several stages can measure the peak of each of them
+    (only possible on Linux).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Return the peak memory usage of this process (since it
+    was last reset, if possible) in bytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceMonitor:
+    """
+    Measures the wall-clock and CPU time, peak memory and I/O of the
+    current process (and any processes it spawns) between its creation
+    and a call to `stop`.
+    """
+    def __init__(self):
+        self.wall_start = time.time()
+        self.cpu_start = self.cpu_time()
+        self.read_start, self.write_start = io_counters()
+
+    def cpu_time(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+    def stop(self):
+        """
+        Return a dictionary with the resources used so far.
+        """
+        read_end, write_end = io_counters()
+        usage = {
+            'walltime': time.time() - self.wall_start,
+            'cpu_time': self.cpu_time() - self.cpu_start,
+            'max_rss': peak_rss(),
+            'read_bytes': None,
+            'write_bytes': None,
+        }
+        if read_end is not None:
+            usage['read_bytes'] = read_end - self.read_start
+            usage['write_bytes'] = write_end - self.write_start
+        return usage
+
+
+def summarize_ranks(stage_name, ranks, map_index=None):
+    """
+    Combine the resources used by each process of a stage (or of one
+    of its map tasks): the wall-clock time and peak memory are the
+    largest of any process, and CPU time and I/O are summed over processes.
+    """
+    def total(key):
+        values = [r[key] for r in ranks]
+        return None if None in values else sum(values)
+
+    return {
+        'stage': stage_name,
+        'map_index': map_index,
+        'nprocess': len(ranks),
+        'walltime': max(r['walltime'] for r in ranks),
+        'cpu_time': total('cpu_time'),
+        'max_rss': max(r['max_rss'] for r in ranks),
+        'read_bytes': total('read_bytes'),
+        'write_bytes': total('write_bytes'),
+    }
+
+
+def write_run_report(filename_base, records):
+    """
+    Write the resources used by each stage of a pipeline run to
+    `filename_base`.json (including the numbers for each process)
+    and `filename_base`.csv (one line per stage).
+    """
+    summaries = [summarize_ranks(r['stage'], r['ranks'], r.get('map_index'))
+                 for r in records]
+    with open(filename_base + '.json', 'w') as f:
+        json.dump([dict(s, ranks=r['ranks']) for s, r in zip(summaries, records)],
+                  f, indent=2)
+    with open(filename_base + '.csv', 'w', newline='') as f:
+        fields = ['stage', 'map_index', 'nprocess', 'walltime', 'cpu_time', 'max_rss',
+                  'read_bytes', 'write_bytes']
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
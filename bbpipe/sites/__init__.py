@@ -1,2 +1,3 @@
 from . import cori
 from . import local
+from . import native
@@ -81,3 +81,44 @@ def make_launcher(stages):
         site_name = add_site_config(launcher, nodes, walltime_minutes, partition)
         stage['site'] = site_name
     return launcher
+
+
+# Resources of a Cori Haswell node, and limits of the debug partition
+CORES_PER_NODE = 32
+MEMORY_PER_NODE = 128 * 1024**3
+DEBUG_WALLTIME_MINUTES = 30
+DEBUG_MAX_NODES = 64
+
+
+def suggest_resources(cpu_time, memory, max_nprocess, cores_per_process=1):
+    """
+    Suggest the nprocess, nodes, walltime (in minutes) and partition
+    to use on Cori for a stage needing `cpu_time` seconds of CPU time in
+    total, and `memory` bytes in each of up to `max_nprocess` processes
+    (each of them using `cores_per_process` cores).
+
+    Processes are added until the stage fits in the debug partition,
+    as far as the stage allows, and the walltime includes a 50% margin.
+    """
+    import math
+    cores_needed = cpu_time / (60 * DEBUG_WALLTIME_MINUTES / 1.5)
+    nprocess = math.ceil(cores_needed / cores_per_process)
+    nprocess = max(1, min(nprocess, max_nprocess))
+
+    # Number of processes that fit in a node, given their memory and cores
+    per_node = CORES_PER_NODE // cores_per_process
+    if memory:
+        per_node = min(per_node, int(MEMORY_PER_NODE // memory))
+    if per_node < 1:
+        raise ValueError(f"Processes needing {memory / 1024**3:.1f} GB "
+                         "of memory don't fit in a Cori node")
+    nodes = math.ceil(nprocess / per_node)
+
+    walltime = math.ceil(1.5 * cpu_time / (60 * nprocess * cores_per_process))
+    walltime = max(walltime, 5)
+    if (walltime <= DEBUG_WALLTIME_MINUTES) and (nodes <= DEBUG_MAX_NODES):
+        partition = 'debug'
+    else:
+        partition = 'regular'
+    return {'nprocess': nprocess, 'nodes': nodes, 'walltime': walltime,
+            'partition': partition}
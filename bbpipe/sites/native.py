@@ -0,0 +1,22 @@
+import copy
+import os
+
+base_launcher = {
+    'mpi_command' : 'mpirun -n',
+    # Maximum number of processes used by all the stages
+    # running at the same time. Defaults to the number of
+    # cores in this machine.
+    'max_cores': None,
+    # Whether to run single-process stages within long-lived
+    # worker processes rather than starting new ones
+    'persistent_workers': False,
+}
+
+
+def make_launcher(stages, max_cores=None, persistent_workers=False):
+    launcher = copy.deepcopy(base_launcher)
+    launcher['max_cores'] = max_cores or os.cpu_count()
+    launcher['persistent_workers'] = persistent_workers
+    for stage in stages:
+        stage['site'] = 'native'
+    return launcher
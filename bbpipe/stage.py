@@ -1,11 +1,31 @@
-import parsl
+import json
 import pathlib
 import sys
 from textwrap import dedent
+from .resources import ResourceMonitor
+from .prefetch import prefetch_iterator
+from .parallel_output import ParallelHDFWriter
 
 SERIAL = 'serial'
 MPI_PARALLEL = 'mpi'
 
+# Parsed configuration files, so that persistent workers running
+# many stages don't parse the same file again
+_config_files = {}
+def load_config_file(filename):
+    """
+    Return a (copy of the) parsed YAML configuration file
+    """
+    import copy
+    import os
+    import yaml
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+    if key not in _config_files:
+        with open(filename) as f:
+            _config_files[key] = yaml.load(f)
+    return copy.deepcopy(_config_files[key])
+
 class PipelineStage:
     """A PipelineStage implements a single calculation step within a wider pipeline.
 
@@ -20,6 +40,15 @@ class PipelineStage:
     parallel = True
     config_options = {}
     doc=""
+    # Stages can be fanned out by the pipeline over the items (one per
+    # line) of the text file with tag `map_input`. The text file with tag
+    # `map_output` then lists the output file of each item, in order.
+    # See map_items for details.
+    map_input = None
+    map_output = None
+    # Coefficients of the cost model used by estimate_resources, which
+    # can be recalibrated in the cost_model section of the pipeline file
+    cost_coefficients = {}
 
     def __init__(self, args):
         if not isinstance(args, dict):
@@ -52,6 +81,10 @@ Missing these names on the command line:
         # command line arguments and optional 'config' file
         self._configs = self.read_config(args)
 
+        self._map_index = args.get('map_index')
+        if (self._map_index is not None) and (self.map_input is None):
+            raise ValueError(f"Stage {self.name} can't be fanned out as it has no map input")
+
         use_mpi = args.get('mpi', False)
         if use_mpi:
             try:
@@ -110,6 +143,57 @@ Missing these names on the command line:
         """Return the path of an output file with the given tag"""
         return self._outputs[tag]
 
+    @classmethod
+    def read_map_items(cls, filename):
+        """Return the items (non-empty lines) of a map input file"""
+        with open(filename) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    @property
+    def map_index(self):
+        """
+        The index of the map input item handled by this process, -1 for
+        the main task of a fanned-out stage, or None if the stage is
+        run as a whole.
+        """
+        return self._map_index
+
+    def is_map_main(self):
+        """
+        Returns True if this process should do the work of the stage that
+        is not specific to the items of its map input, i.e. unless it is
+        one of the item tasks of a fanned-out stage.
+        """
+        return (self._map_index is None) or (self._map_index < 0)
+
+    def map_items(self):
+        """
+        Return the (index, item) pairs of the map input that this process
+        should handle. When the stage is run as a whole these are all the
+        items. When the pipeline fans it out, the main task (--map_index=-1)
+        runs first and handles none of them, and then a separate task
+        (--map_index=i) handles each item.
+        """
+        items = self.read_map_items(self.get_input(self.map_input))
+        if self._map_index is None:
+            return list(enumerate(items))
+        if self._map_index < 0:
+            return []
+        if self._map_index >= len(items):
+            raise ValueError(f"Map index {self._map_index} out of range "
+                             f"({len(items)} items in {self.map_input})")
+        return [(self._map_index, items[self._map_index])]
+
+    def write_map_output(self, filenames):
+        """
+        Write the output files of all the items of the map input, in
+        order, to the map output file. This should be done by the main
+        task (i.e. if is_map_main()).
+        """
+        with open(self.get_output(self.map_output), 'w') as f:
+            for fname in filenames:
+                f.write(fname+"\n")
+
     def open_input(self, tag, wrapper=False, **kwargs):
         """
         Find and open an input file with the given tag, in read-only mode.
@@ -175,6 +259,19 @@ Missing these names on the command line:
         else:
             return obj.file
 
+    def open_shared_output(self, filename):
+        """
+        Open an HDF5 file with datasets into which each process writes
+        the rows it has computed (e.g. its share of a batch of simulations).
+
+        This must be called by all processes. Datasets are created with
+        `create_dataset(name, shape)` and rows written with
+        `write(name, start, data)`, and the file is complete once the
+        returned object has been closed. This works whether or not h5py
+        is MPI-enabled - see ParallelHDFWriter for details.
+        """
+        return ParallelHDFWriter(filename, self.comm)
+
     @property
     def config(self):
         """
@@ -200,11 +297,10 @@ Missing these names on the command line:
         self.config_options holds a type instead of a value.
         """
         # Try to load configuration file if provided
-        import yaml
 
         # This is all the config information in the file, including
         # things for other stages
-        overall_config = yaml.load(open(self.get_input('config')))
+        overall_config = load_config_file(self.get_input('config'))
         
         # The user can define global options that are inherited by
         # all the other sections if not already specified there.
@@ -375,23 +471,43 @@ Missing these names on the command line:
 
         return cwl_tool
 
-    def iterate_fits(self, tag, hdunum, cols, chunk_rows):
+    def iterate_fits(self, tag, hdunum, cols, chunk_rows, prefetch=True, contiguous=True):
         """
         Loop through chunks of the input data from a FITS file with the given tag
+
+        Under MPI, each process gets a contiguous block of chunks (or every
+        size-th chunk if `contiguous` is False). If `prefetch` is True, the
+        next chunk is read in the background while the current one is used.
         """
         fits = self.open_input(tag)
         ext = fits[hdunum]
         n = ext.get_nrows()
-        for start,end in self.data_ranges_by_rank(n, chunk_rows):
-            data = ext.read_columns(cols, rows=range(start, end))
-            yield start, end, data
 
-    def iterate_hdf(self, tag, group_name, cols, chunk_rows):
+        def read_chunks():
+            for start,end in self.data_ranges_by_rank(n, chunk_rows, contiguous=contiguous):
+                data = ext.read_columns(cols, rows=range(start, end))
+                yield start, end, data
+
+        chunks = read_chunks()
+        if prefetch:
+            chunks = prefetch_iterator(chunks)
+        yield from chunks
+
+    def iterate_hdf(self, tag, group_name, cols, chunk_rows, prefetch=True, contiguous=True,
+                    reuse_buffers=False):
         """
         Loop through chunks of the input data from an HDF5 file with the given tag.
 
         All the selected columns must have the same length.
 
+        Under MPI, each process gets a contiguous block of chunks (or every
+        size-th chunk if `contiguous` is False). If `prefetch` is True, the
+        next chunk is read in the background while the current one is used.
+
+        If `reuse_buffers` is True, chunks are read directly into a few
+        preallocated arrays that are reused, instead of new arrays for every
+        chunk. The arrays yielded are then only valid until the next chunk
+        is requested, and should be copied if they are needed after that.
         """
         import numpy as np
         hdf = self.open_input(tag)
@@ -404,13 +520,31 @@ Missing these names on the command line:
             raise ValueError(f"Different columns among {cols} in file {tag}\
             group {group_name} are different sizes - cannot use iterate_hdf")
 
-        # Iterate through the data providing chunks
-        for start, end in self.data_ranges_by_rank(n, chunk_rows):
-            data = {col: group[col][start:end] for col in cols}
-            yield start, end, data
-
-
+        ranges = list(self.data_ranges_by_rank(n, chunk_rows, contiguous=contiguous))
+
+        def read_chunks():
+            if reuse_buffers:
+                # When prefetching, one chunk can be in use, another one
+                # waiting and a third one being read
+                n_buffers = 3 if prefetch else 1
+                buffers = [{col: np.empty((min(chunk_rows, n),)+group[col].shape[1:],
+                                          dtype=group[col].dtype)
+                            for col in cols} for i in range(n_buffers)]
+
+            for i, (start, end) in enumerate(ranges):
+                if reuse_buffers:
+                    data = {}
+                    for col in cols:
+                        data[col] = buffers[i % n_buffers][col][:end-start]
+                        group[col].read_direct(data[col], np.s_[start:end])
+                else:
+                    data = {col: group[col][start:end] for col in cols}
+                yield start, end, data
 
+        chunks = read_chunks()
+        if prefetch:
+            chunks = prefetch_iterator(chunks)
+        yield from chunks
 
     def get_input_type(self, tag):
         """Return the file type class of an input file with the given tag."""
@@ -433,11 +567,21 @@ Missing these names on the command line:
             if i%self.size==self.rank:
                 yield task
 
-    def data_ranges_by_rank(self, n_rows, chunk_rows):
+    def data_ranges_by_rank(self, n_rows, chunk_rows, contiguous=False):
+        """
+        Yield the (start, end) rows of the chunks of data that this process
+        should handle: either a contiguous block of chunks, or every
+        size-th chunk starting with this process's rank.
+        """
         n_chunks = n_rows//chunk_rows
         if n_chunks*chunk_rows<n_rows:
             n_chunks += 1
-        for i in self.split_tasks_by_rank(range(n_chunks)):
+        if contiguous:
+            chunks = range((self.rank*n_chunks)//self.size,
+                           ((self.rank+1)*n_chunks)//self.size)
+        else:
+            chunks = self.split_tasks_by_rank(range(n_chunks))
+        for i in chunks:
             start = i*chunk_rows
             end = min((i+1)*chunk_rows, n_rows)
             yield start, end
@@ -605,6 +749,8 @@ I currently know about these stages:
         parser.add_argument('--config')
         parser.add_argument('--mpi', action='store_true', help="Set up MPI parallelism")
         parser.add_argument('--pdb', action='store_true', help="Run under the python debugger")
+        parser.add_argument('--resources', help="Write the resources used by the stage to this JSON file")
+        parser.add_argument('--map_index', type=int, help="Index of the map input item to process (-1 for none)")
         args = parser.parse_args()
         return args
 
@@ -615,6 +761,7 @@ I currently know about these stages:
         with the specified inputs and outputs
         """
         import pdb
+        monitor = ResourceMonitor()
         stage = cls(args)
         if stage.rank==0:
             print(f"Executing stage: {cls.name}")
@@ -629,37 +776,77 @@ I currently know about these stages:
             else:
                 raise
 
+        resources_file = getattr(args, 'resources', None)
+        if resources_file:
+            stage.write_resources(resources_file, monitor.stop())
+
+    def write_resources(self, filename, usage):
+        """
+        Write the resources used by each process of this stage
+        (as measured by a ResourceMonitor) to a JSON file.
+        """
+        if self.comm is None:
+            ranks = [usage]
+        else:
+            ranks = self.comm.gather(usage)
+        if self.rank == 0:
+            with open(filename, 'w') as f:
+                json.dump({'stage': self.name, 'map_index': self.map_index, 'ranks': ranks},
+                          f, indent=2)
+
+    @classmethod
+    def estimate_resources(cls, config, files, coefficients):
+        """
+        Estimate the resources needed to run this stage, without running it.
+        Stages with a cost model should override this.
+
+        `config` is the configuration of the stage, `files` the paths of
+        all the pipeline's files by tag (those generated by earlier stages
+        may not exist yet), and `coefficients` those of the cost model
+        (cost_coefficients, with any overrides from the pipeline file).
+
+        Returns None if the resources can't be estimated, or a dictionary with:
+        - cpu_time: the total CPU time, in seconds
+        - memory: the peak memory of each process, in bytes
+        - max_nprocess: the number of processes the work can be split over
+        - cores_per_process (optional): the cores used by each process
+        """
+        return None
+
+    @classmethod
+    def count_items(cls, filename):
+        """
+        Return the number of items (non-empty lines) of a text file,
+        or None if it doesn't exist (e.g. before the pipeline is run).
+        """
+        import os
+        if filename is None or not os.path.exists(filename):
+            return None
+        return len(cls.read_map_items(filename))
+
     @classmethod
     def _generate(cls, template, dfk):
-        # dfk needs to be an argument here because it is
-        # referenced in the template that is exec'd.
+        # dfk and parsl need to be local variables here because
+        # they are referenced in the template that is exec'd.
+        import parsl
         d = locals().copy()
         exec(template, globals(), d)
         function = d[cls.name]
         return function
 
     @classmethod
-    def generate_command(cls, external_inputs, config, outdir, nprocess=1, mpi_command='mpirun -n'):
+    def generate_command(cls, external_inputs, config, outdir, nprocess=1, mpi_command='mpirun -n',
+                         resources=None, map_index=None):
         """
-        Generate a command line that will run the stage
+        Generate a command line that will run the stage (or one of
+        its map tasks), optionally writing the resources it used
+        to the file `resources`
         """
         module = cls.get_module()
         module = module.split('.')[0]
 
-        # Collect flags.
-        # This is a bit different from the case within the
-        # parsl pipeline because of where we find the inputs,
-        # even if the end result is usually the same
-        flags = [cls.name]
-        for tag,ftype in cls.inputs + cls.outputs:
-            if tag in external_inputs:
-                fpath = external_inputs[tag]
-            else:
-                fpath = f'{outdir}/{tag}.{ftype.suffix}'
-            flag = f'--{tag}={fpath}'
-            flags.append(flag)
-
-        flags.append(f'--config={config}')
+        flags = cls.generate_args(external_inputs, config, outdir,
+                                  resources=resources, map_index=map_index)
         flags = "   ".join(flags)
 
         # This is identical to the parsl case however
@@ -676,9 +863,37 @@ I currently know about these stages:
         return cmd
 
     @classmethod
-    def generate(cls, dfk, nprocess, site_name, log_dir, mpi_command='mpirun -n'):
+    def generate_args(cls, external_inputs, config, outdir, resources=None, map_index=None):
         """
-        Build a parsl bash app that executes this pipeline stage
+        Generate the command line arguments that will run the
+        stage (starting with its name)
+        """
+        # Collect flags.
+        # This is a bit different from the case within the
+        # parsl pipeline because of where we find the inputs,
+        # even if the end result is usually the same
+        flags = [cls.name]
+        for tag,ftype in cls.inputs + cls.outputs:
+            if tag in external_inputs:
+                fpath = external_inputs[tag]
+            else:
+                fpath = f'{outdir}/{tag}.{ftype.suffix}'
+            flag = f'--{tag}={fpath}'
+            flags.append(flag)
+
+        flags.append(f'--config={config}')
+        if resources is not None:
+            flags.append(f'--resources={resources}')
+        if map_index is not None:
+            flags.append(f'--map_index={map_index}')
+        return flags
+
+    @classmethod
+    def generate(cls, dfk, nprocess, site_name, log_dir, mpi_command='mpirun -n',
+                 retries=0, retry_delay=10.):
+        """
+        Build a parsl bash app that executes this pipeline stage, retrying
+        it up to `retries` times after increasing delays if it fails
         """
         module = cls.get_module()
         module = module.split('.')[0]
@@ -696,6 +911,8 @@ I currently know about these stages:
             flag = '--{}={{outputs[{}]}}'.format(out,i)
             flags.append(flag)
 
+        flags.append(f'--resources={log_dir}/{cls.name}.resources.json')
+
         flags = "   ".join(flags)
 
         # The last input file is always the config
@@ -709,10 +926,15 @@ I currently know about these stages:
             launcher = ""
             mpi_flag = ""
 
+        cmd = f'{launcher} python3 -m {module} {flags} {mpi_flag}'
+        retry_cmd = cmd
+        for i in range(retries):
+            retry_cmd += f' || (sleep {retry_delay * 2**i:g} && {cmd})'
+
         template = f"""
 @parsl.App('bash', dfk, sites=['{site_name}'])
 def {cls.name}(inputs, outputs, stdout='{log_dir}/{cls.name}.out', stderr='{log_dir}/{cls.name}.err'):
-    cmd = '{launcher} python3 -m {module} {flags} {mpi_flag}'.format(inputs=inputs,outputs=outputs)
+    cmd = '{retry_cmd}'.format(inputs=inputs,outputs=outputs)
     print("Compiling command:")
     print(cmd)
     return cmd
@@ -4,5 +4,6 @@ from .maps_preproc import BBMapsPreproc
 from .power_specter import BBPowerSpecter
 from .power_summarizer import BBPowerSummarizer
 from .covfefe import BBCovFeFe
+from .null_tester import BBNullTester
 from .compsep import BBCompSep
 from .plotter import BBPlotter
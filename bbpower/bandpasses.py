@@ -51,15 +51,27 @@ class Bandpass(object):
 
         self.cmb_norm = 1./np.sum(CMB('K_RJ').eval(self.nu) * self.bnu_dnu)
 
+    def set_param_indices(self, params):
+        """
+        Finds the positions of this bandpass' systematics parameters
+        in the parameter vectors built by the ParameterManager `params`.
+        """
+        if self.do_shift:
+            self.i_shift = params.index(self.name_shift)
+        if self.do_gain:
+            self.i_gain = params.index(self.name_gain)
+        if self.do_angle:
+            self.i_angle = params.index(self.name_angle)
+
     def convolve_sed(self, sed, params):
         dnu = 0.
         if self.do_shift:
-            dnu = params[self.name_shift] * self.nu_mean
+            dnu = params[self.i_shift] * self.nu_mean
 
         conv_sed = np.sum(sed(self.nu + dnu) * self.bnu_dnu) * self.cmb_norm
 
         if self.do_gain:
-            conv_sed *= params[self.name_gain]
+            conv_sed *= params[self.i_gain]
 
         if self.is_complex:
             mod = abs(conv_sed)
@@ -71,7 +83,7 @@ class Bandpass(object):
 
     def get_rotation_matrix(self, params):
         if self.do_angle:
-            phi = params[self.name_angle]
+            phi = params[self.i_angle]
             c=np.cos(2*phi)
             s=np.sin(2*phi)
             return np.array([[c,s],[-s,c]])
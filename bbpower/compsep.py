@@ -6,7 +6,9 @@ from bbpipe import PipelineStage
 from .types import NpzFile, SACCFile
 from .fg_model import FGModel
 from .param_manager import ParameterManager
+from .samplers import Sampler
 from .bandpasses import Bandpass, rotate_cells, rotate_cells_mat
+from .windows import expand_window, windows_lmax
 from fgbuster.component_model import CMB 
 from sacc.sacc import SACC
 
@@ -20,7 +22,36 @@ class BBCompSep(PipelineStage):
     inputs = [('cells_coadded', SACCFile),('cells_noise', SACCFile),('cells_fiducial', SACCFile)]
     outputs = [('param_chains', NpzFile), ('config_copy', NpzFile)]
     config_options={'likelihood_type':'h&l', 'n_iters':32, 'nwalkers':16, 'r_init':1.e-3,
-                    'sampler':'emcee'}
+                    'sampler':'emcee', 'n_checkpoint':100, 'n_tau_stop':0,
+                    'n_pool':1, 'nlive':400, 'dlogz':0.1, 'checkpoint_time':600}
+    # Rough cost model (see estimate_resources)
+    cost_coefficients={'lnprob_time':1e-3,  # s per likelihood evaluation, unless measured
+                       'dynesty_calls':300, # likelihood evaluations per live point (dynesty)
+                       'other_calls':1000,  # likelihood evaluations (other samplers)
+                       'memory':1e9}
+
+    @classmethod
+    def estimate_resources(cls, config, files, coefficients):
+        # The number of likelihood evaluations times the time each of them
+        # takes, as measured by a previous run with the 'timing' sampler
+        # if its output is available. Evaluations are split over n_pool cores.
+        c = coefficients
+        lnprob_time = c['lnprob_time']
+        fname_chains = files.get('param_chains')
+        if fname_chains and os.path.isfile(fname_chains):
+            with np.load(fname_chains) as chains:
+                if 'timing' in chains:
+                    lnprob_time = float(chains['timing'])
+
+        sampler = config.get('sampler')
+        if sampler in ['emcee', 'zeus']:
+            n_calls = config['nwalkers']*config['n_iters']
+        elif sampler == 'dynesty':
+            n_calls = config['nlive']*c['dynesty_calls']
+        else:
+            n_calls = c['other_calls']
+        return {'cpu_time':n_calls*lnprob_time, 'memory':c['memory'], 'max_nprocess':1,
+                'cores_per_process':max(config['n_pool'],1)}
 
     def setup_compsep(self):
         """
@@ -30,10 +61,32 @@ class BBCompSep(PipelineStage):
         self.load_cmb()
         self.fg_model = FGModel(self.config)
         self.params = ParameterManager(self.config)
+        self.set_param_indices()
         if self.use_handl:
             self.prepare_h_and_l()
         return
 
+    def set_param_indices(self):
+        """
+        Finds the positions of all model parameters in the parameter
+        vectors built by the ParameterManager, so they can be looked up
+        by index when evaluating the likelihood.
+        """
+        self.i_r_tensor = self.params.index('r_tensor')
+        self.i_A_lens = self.params.index('A_lens')
+        for c_name in self.fg_model.component_names:
+            comp = self.fg_model.components[c_name]
+            comp['i_sed'] = [self.params.index(comp['names_sed_dict'][k])
+                             for k in comp['sed'].params]
+            comp['i_cl'] = {}
+            for cl_comb, clfunc in comp['cl'].items():
+                comp['i_cl'][cl_comb] = [self.params.index(comp['names_cl_dict'][cl_comb][k])
+                                         for k in clfunc.params]
+            comp['i_x'] = {c_name2: self.params.index(epsname)
+                           for c_name2, epsname in comp['names_x_dict'].items()}
+        for bp in self.bpss:
+            bp.set_param_indices(self.params)
+
     def matrix_to_vector(self, mat):
         return mat[..., self.index_ut[0], self.index_ut[1]]
 
@@ -51,6 +104,25 @@ class BBCompSep(PipelineStage):
             raise ValueError("Input vector can only be 1- or 2-D")
         return mat
 
+    def get_sacc_indices(self):
+        """
+        Returns an [n_bpws, ncross] array of indices into the SACC data vector
+        such that `v[indices]` is the data in the internal ordering.
+        """
+        indices = -np.ones([self.n_bpws, self.ncross], dtype=int)
+        for t1,t2,typ,ells,ndx in self.order:
+            p1,p2=typ.decode()
+            ip1=self.pol_order[p1]
+            ip2=self.pol_order[p2]
+            # Ordering is such that polarization channel is the fastest varying index
+            ind_vec=self.vector_indices[t1*self.npol + ip1, t2*self.npol + ip2]
+            if len(ells) != self.n_bpws:
+                raise ValueError("All power spectra need to be sampled at the same ells")
+            indices[:, ind_vec] = ndx
+        if np.any(indices < 0):
+            raise ValueError("Some cross-correlations are missing from the SACC file")
+        return indices
+
     def parse_sacc_file(self):
         """
         Reads the data in the sacc file included the power spectra, bandpasses, and window functions. 
@@ -59,7 +131,10 @@ class BBCompSep(PipelineStage):
         self.use_handl = self.config['likelihood_type'] == 'h&l'
 
         #Read data
-        self.s = SACC.loadFromHDF(self.get_input('cells_coadded'))
+        #The covariance can be read from a different file (e.g. the
+        #analytic covariance computed by BBCovFeFe)
+        self.s = SACC.loadFromHDF(self.get_input('cells_coadded'),
+                                  precision_filename=self.config.get('covariance_file'))
         if self.use_handl:
             s_fid = SACC.loadFromHDF(self.get_input('cells_fiducial'), \
                                      precision_filename=self.get_input('cells_coadded'))
@@ -101,18 +176,8 @@ class BBCompSep(PipelineStage):
             bnu = t.Nz
             self.bpss.append(Bandpass(nu, dnu, bnu, i_t+1, self.config))
 
-        #Get ell sampling
-        #Avoid l<2
-        mask_w = self.s.binning.windows[0].ls > 1
-        self.bpw_l = self.s.binning.windows[0].ls[mask_w]
-        self.n_ell = len(self.bpw_l)
-        # D_ell factor
-        self.dl2cl = 2 * np.pi / (self.bpw_l * (self.bpw_l + 1))
-        if self.config.get('compute_dell'):
-            self.dl2cl = 1.
         _,_,_,self.ell_b,_ = self.order[0]
         self.n_bpws = len(self.ell_b)
-        self.windows = np.zeros([self.ncross, self.n_bpws, self.n_ell])
 
         #Get power spectra and covariances
         v = self.s.mean.vector
@@ -121,69 +186,83 @@ class BBCompSep(PipelineStage):
         cv = self.s.precision.getCovarianceMatrix()
 
         #Parse into the right ordering
-        v2d = np.zeros([self.n_bpws, self.ncross])
-        if self.use_handl:
-            v2d_noi = np.zeros([self.n_bpws, self.ncross])
-            v2d_fid = np.zeros([self.n_bpws, self.ncross])
-        cv2d = np.zeros([self.n_bpws, self.ncross, self.n_bpws, self.ncross])
         self.vector_indices = self.vector_to_matrix(np.arange(self.ncross, dtype=int)).astype(int)
-        self.indx = []
-        for t1,t2,typ,ells,ndx in self.order:
-            p1,p2=typ.decode()
-            ip1=self.pol_order[p1]
-            ip2=self.pol_order[p2]
-            # Ordering is such that polarization channel is the fastest varying index
-            ind_vec=self.vector_indices[t1*self.npol + ip1, t2*self.npol + ip2]
-            for b,i in enumerate(ndx):
-                self.windows[ind_vec, b, :] = self.s.binning.windows[i].w[mask_w]
-            v2d[:, ind_vec] = v[ndx]
-            if self.use_handl:
-                v2d_noi[:, ind_vec] = s_noi.mean.vector[ndx]
-                v2d_fid[:, ind_vec] = s_fid.mean.vector[ndx]
-            if len(ells) != self.n_bpws:
-                raise ValueError("All power spectra need to be sampled at the same ells")
-            for t1b, t2b, typb, ellsb, ndxb in self.order:
-                p1b,p2b=typb.decode()
-                ip1b=self.pol_order[p1b]
-                ip2b=self.pol_order[p2b]
-                ind_vecb=self.vector_indices[t1b*self.npol + ip1b, t2b*self.npol + ip2b]
-                cv2d[:, ind_vec, :, ind_vecb] = cv[ndx, :][:, ndxb]
+        self.sacc_indices = self.get_sacc_indices()
+        ndx_all = self.sacc_indices.flatten()
+        v2d = v[self.sacc_indices]
+        if self.use_handl:
+            v2d_noi = s_noi.mean.vector[self.sacc_indices]
+            v2d_fid = s_fid.mean.vector[self.sacc_indices]
+
+        #Get ell sampling
+        #Avoid l<2, and multipoles above those covered by the windows
+        windows = [self.s.binning.windows[i] for i in self.sacc_indices.T.flatten()]
+        self.bpw_l = np.arange(2, windows_lmax(windows)+1)
+        self.n_ell = len(self.bpw_l)
+        # D_ell factor
+        self.dl2cl = 2 * np.pi / (self.bpw_l * (self.bpw_l + 1))
+        if self.config.get('compute_dell'):
+            self.dl2cl = 1.
+        # Windows are stored as [ncross, n_bpws, n_ell]
+        self.windows = np.array([expand_window(w, self.bpw_l) for w in windows])
+        self.windows = self.windows.reshape([self.ncross, self.n_bpws, self.n_ell])
 
         #Store data
         self.bbdata = self.vector_to_matrix(v2d)
         if self.use_handl:
             self.bbnoise = self.vector_to_matrix(v2d_noi)
             self.bbfiducial = self.vector_to_matrix(v2d_fid)
-        self.bbcovar = cv2d.reshape([self.n_bpws * self.ncross, self.n_bpws * self.ncross])
+        self.bbcovar = cv[np.ix_(ndx_all, ndx_all)]
         self.invcov = np.linalg.solve(self.bbcovar, np.identity(len(self.bbcovar)))
         return
 
     def load_cmb(self):
         """
         Loads the CMB BB spectrum as defined in the config file. 
+        The templates are interpolated onto the ell sampling of the bandpower
+        windows, and convolved with the windows of all cross-correlations, so
+        that the CMB contribution to the model is just a linear combination
+        of precomputed bandpowers.
         """
         cmb_lensingfile = np.loadtxt(self.config['cmb_model']['cmb_templates'][0])
         cmb_bbfile = np.loadtxt(self.config['cmb_model']['cmb_templates'][1])
-        
-        self.cmb_ells = cmb_bbfile[:, 0]
-        mask = (self.cmb_ells <= self.bpw_l.max()) & (self.cmb_ells > 1)
-        self.cmb_ells = self.cmb_ells[mask]
-
-        # TODO: this is a patch
-        nell = len(self.cmb_ells)
-        self.cmb_tens = np.zeros([self.npol, self.npol, nell])
-        self.cmb_lens = np.zeros([self.npol, self.npol, nell])
-        self.cmb_scal = np.zeros([self.npol, self.npol, nell])
+
+        def interp_template(data, column):
+            ells = data[:, 0]
+            if (ells.min() > self.bpw_l.min()) or (ells.max() < self.bpw_l.max()):
+                raise ValueError("CMB templates don't cover the ell range of the bandpower windows")
+            return np.interp(self.bpw_l, ells, data[:, column])
+
+        self.cmb_ells = self.bpw_l
+        self.cmb_tens = np.zeros([self.npol, self.npol, self.n_ell])
+        self.cmb_lens = np.zeros([self.npol, self.npol, self.n_ell])
+        self.cmb_scal = np.zeros([self.npol, self.npol, self.n_ell])
         if 'B' in self.config['pol_channels']:
             ind = self.pol_order['B']
-            self.cmb_tens[ind, ind] = cmb_bbfile[:, 3][mask] - cmb_lensingfile[:, 3][mask]
-            self.cmb_lens[ind, ind] = cmb_lensingfile[:, 3][mask]
+            self.cmb_tens[ind, ind] = interp_template(cmb_bbfile, 3) - interp_template(cmb_lensingfile, 3)
+            self.cmb_lens[ind, ind] = interp_template(cmb_lensingfile, 3)
         if 'E' in self.config['pol_channels']:
             ind = self.pol_order['E']
-            self.cmb_tens[ind, ind] = cmb_bbfile[:, 2][mask] - cmb_lensingfile[:, 2][mask]
-            self.cmb_scal[ind, ind] = cmb_lensingfile[:, 2][mask]
+            self.cmb_tens[ind, ind] = interp_template(cmb_bbfile, 2) - interp_template(cmb_lensingfile, 2)
+            self.cmb_scal[ind, ind] = interp_template(cmb_lensingfile, 2)
+
+        # Bandpowers, [n_bpws, nmaps, nmaps]
+        self.cmb_bpw_tens = self.convolve_windows_cmb(self.cmb_tens)
+        self.cmb_bpw_lens = self.convolve_windows_cmb(self.cmb_lens)
+        self.cmb_bpw_scal = self.convolve_windows_cmb(self.cmb_scal)
         return
 
+    def convolve_windows_cmb(self, cls):
+        """
+        Convolves a [npol, npol, n_ell] CMB power spectrum with the bandpower
+        windows of all cross-correlations, returning an [n_bpws, nmaps, nmaps] array.
+        """
+        # Polarization channels of each cross-correlation
+        ip1 = self.index_ut[0] % self.npol
+        ip2 = self.index_ut[1] % self.npol
+        cls_x = cls[ip1, ip2] * self.dl2cl  # [ncross, nell]
+        return self.vector_to_matrix(np.einsum('ijk,ik->ji', self.windows, cls_x))
+
     def integrate_seds(self, params):
         fg_scaling = np.zeros([self.fg_model.n_components, self.nfreqs])
         rot_matrices = []
@@ -191,8 +270,7 @@ class BBCompSep(PipelineStage):
         for i_c, c_name in enumerate(self.fg_model.component_names):
             comp = self.fg_model.components[c_name]
             units = comp['cmb_n0_norm']
-            sed_params = [params[comp['names_sed_dict'][k]] 
-                          for k in comp['sed'].params]
+            sed_params = params[comp['i_sed']]
             rot_matrices.append([])
             def sed(nu):
                 return comp['sed'].eval(nu, *sed_params)
@@ -216,16 +294,15 @@ class BBCompSep(PipelineStage):
                 m1, m2 = cl_comb
                 ip1 = self.pol_order[m1]
                 ip2 = self.pol_order[m2]
-                pspec_params = [params[comp['names_cl_dict'][cl_comb][k]]
-                                for k in clfunc.params]
+                pspec_params = params[comp['i_cl'][cl_comb]]
                 fg_pspectra[i_c, i_c, ip1, ip2, :] = clfunc.eval(self.bpw_l, *pspec_params) * self.dl2cl
 
         # Off diagonals
         for i_c1, c_name1 in enumerate(self.fg_model.component_names):
-            for c_name2, epsname in self.fg_model.components[c_name1]['names_x_dict'].items():
+            for c_name2, i_eps in self.fg_model.components[c_name1]['i_x'].items():
                 i_c2 = self.fg_model.component_order[c_name2]
                 cl_x=np.sqrt(np.fabs(fg_pspectra[i_c1, i_c1]*
-                                     fg_pspectra[i_c2, i_c2])) * params[epsname]
+                                     fg_pspectra[i_c2, i_c2])) * params[i_eps]
                 fg_pspectra[i_c1, i_c2] = cl_x
                 fg_pspectra[i_c2, i_c1] = cl_x
 
@@ -235,19 +312,18 @@ class BBCompSep(PipelineStage):
         """
         Defines the total model and integrates over the bandpasses and windows. 
         """
-        cmb_cell = (params['r_tensor'] * self.cmb_tens + \
-                    params['A_lens'] * self.cmb_lens + \
-                    self.cmb_scal) * self.dl2cl # [npol,npol,nell]
+        cmb_bpw = (params[self.i_r_tensor] * self.cmb_bpw_tens + \
+                   params[self.i_A_lens] * self.cmb_bpw_lens + \
+                   self.cmb_bpw_scal) # [n_bpws,nmaps,nmaps]
         fg_scaling, rot_m = self.integrate_seds(params)  # [nfreq, ncomp], [ncomp,nfreq,[matrix]]
         fg_cell = self.evaluate_power_spectra(params)  # [ncomp,ncomp,npol,npol,nell]
 
         # Add all components scaled in frequency (and HWP-rotated if needed)
         cls_array_fg = np.zeros([self.nfreqs,self.nfreqs,self.n_ell,self.npol,self.npol])
         fg_cell = np.transpose(fg_cell, axes = [0,1,4,2,3])  # [ncomp,ncomp,nell,npol,npol]
-        cmb_cell = np.transpose(cmb_cell, axes = [2,0,1]) # [nell,npol,npol]
         for f1 in range(self.nfreqs):
             for f2 in range(f1,self.nfreqs):  # Note that we only need to fill in half of the frequencies
-                cls=cmb_cell.copy()
+                cls=np.zeros([self.n_ell,self.npol,self.npol])
 
                 # Loop over component pairs
                 for c1 in range(self.fg_model.n_components):
@@ -277,6 +353,9 @@ class BBCompSep(PipelineStage):
                         if m1!=m2:
                             cls_array_list[:, f2, p2, f1, p1] = clband
 
+        # Add CMB, already convolved with the windows
+        cls_array_list += cmb_bpw.reshape([self.n_bpws, self.nfreqs, self.npol, self.nfreqs, self.npol])
+
         # Polarization angle rotation
         for f1 in range(self.nfreqs):
             for f2 in range(self.nfreqs):
@@ -329,143 +408,33 @@ class BBCompSep(PipelineStage):
             rot[:, i] = U[:, i] * d
         return rot.dot(U.T)
 
-    def lnprob(self, par):
+    def lnlike(self, par):
         """
-        Likelihood with priors. 
+        Likelihood without priors.
         """
-        prior = self.params.lnprior(par)
-        if not np.isfinite(prior):
-            return -np.inf
-
         params = self.params.build_params(par)
         if self.use_handl:
             dx = self.h_and_l_dx(params)
         else:
             dx = self.chi_sq_dx(params)
-        like = -0.5 * np.einsum('i, ij, j',dx,self.invcov,dx)
-        return prior + like
+        return -0.5 * np.einsum('i, ij, j',dx,self.invcov,dx)
 
-    def emcee_sampler(self):
-        """
-        Sample the model with MCMC. 
-        """
-        import emcee
-        from multiprocessing import Pool
-        
-        fname_temp = self.get_output('param_chains')+'.h5'
-
-        backend = emcee.backends.HDFBackend(fname_temp)
-
-        nwalkers = self.config['nwalkers']
-        n_iters = self.config['n_iters']
-        ndim = len(self.params.p0)
-        found_file = os.path.isfile(fname_temp)
-
-        if not found_file:
-            backend.reset(nwalkers,ndim)
-            pos = [self.params.p0 + 1.e-3*np.random.randn(ndim) for i in range(nwalkers)]
-            nsteps_use = n_iters
-        else:
-            print("Restarting from previous run")
-            pos = None
-            nsteps_use = max(n_iters-len(backend.get_chain()), 0)
-                                    
-        with Pool() as pool:
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, self.lnprob,backend=backend)
-            if nsteps_use > 0:
-                sampler.run_mcmc(pos, nsteps_use, store=True, progress=True);
-
-        return sampler
-
-    def minimizer(self):
-        """
-        Find maximum likelihood
-        """
-        from scipy.optimize import minimize
-        def chi2(par):
-            c2=-2*self.lnprob(par)
-            return c2
-        res=minimize(chi2, self.params.p0, method="Powell")
-        return res.x
-
-    def fisher(self):
-        """
-        Evaluate Fisher matrix
-        """
-        import numdifftools as nd
-        def lnprobd(p):
-            l = self.lnprob(p)
-            if l == -np.inf:
-                l = -1E100
-            return l
-        fisher = - nd.Hessian(lnprobd)(self.params.p0)
-        return fisher
-
-    def singlepoint(self):
-        """
-        Evaluate at a single point
-        """
-        chi2 = -2*self.lnprob(self.params.p0)
-        return chi2
-
-    def timing(self, n_eval=300):
+    def lnprob(self, par):
         """
-        Evaluate n times and benchmark
+        Likelihood with priors. 
         """
-        import time
-        start = time.time()
-        for i in range(n_eval):
-            lik = self.lnprob(self.params.p0)
-        end = time.time()
+        prior = self.params.lnprior(par)
+        if not np.isfinite(prior):
+            return -np.inf
 
-        return end-start, (end-start)/n_eval
+        return prior + self.lnlike(par)
 
     def run(self):
         from shutil import copyfile
         copyfile(self.get_input('config'), self.get_output('config_copy')) 
         self.setup_compsep()
-        if self.config.get('sampler')=='emcee':
-            sampler = self.emcee_sampler()
-            np.savez(self.get_output('param_chains'),
-                     chain=sampler.chain,         
-                     names=self.params.p_free_names)
-            print("Finished sampling")
-        elif self.config.get('sampler')=='fisher':
-            fisher = self.fisher()
-            cov = np.linalg.inv(fisher)
-            for i,(n,p) in enumerate(zip(self.params.p_free_names,
-                                         self.params.p0)):
-                print(n+" = %.3lE +- %.3lE" % (p, np.sqrt(cov[i, i])))
-            np.savez(self.get_output('param_chains'),
-                     fisher=fisher,
-                     names=self.params.p_free_names)
-        elif self.config.get('sampler')=='maximum_likelihood':
-            sampler = self.minimizer()
-            chi2 = -2*self.lnprob(sampler)
-            np.savez(self.get_output('param_chains'),
-                     params=sampler,
-                     names=self.params.p_free_names,
-                     chi2=chi2)
-            print("Best fit:")
-            for n,p in zip(self.params.p_free_names,sampler):
-                print(n+" = %.3lE" % p)
-            print("Chi2: %.3lE" % chi2)
-        elif self.config.get('sampler')=='single_point':
-            sampler = self.singlepoint()
-            np.savez(self.get_output('param_chains'),
-                     chi2=sampler,
-                     names=self.params.p_free_names)
-            print("Chi^2:",sampler)
-        elif self.config.get('sampler')=='timing':
-            sampler = self.timing()
-            np.savez(self.get_output('param_chains'),
-                     timing=sampler[1],
-                     names=self.params.p_free_names)
-            print("Total time:",sampler[0])
-            print("Time per eval:",sampler[1])
-        else:
-            raise ValueError("Unknown sampler")
-
+        sampler = Sampler.get_sampler(self.config.get('sampler'))(self)
+        sampler.run()
         return
 
 if __name__ == '__main__':
@@ -0,0 +1,23 @@
+import numpy as np
+import os
+
+
+def n_bandpowers(nside, bpw_edges):
+    """
+    Return the number of bandpowers that BBPowerSpecter uses for a given
+    `bpw_edges` (a file with the bandpower edges, or a constant width),
+    or None if it can't be worked out.
+    """
+    lmax = 3*nside
+    if isinstance(bpw_edges, str):
+        if not os.path.isfile(bpw_edges):
+            return None
+        edges = np.loadtxt(bpw_edges).astype(int)
+        nbpw = int(np.sum(edges[1:] < lmax))
+        # Equi-spaced bandpowers are added up to the end of the band
+        if edges[-1] < lmax:
+            nbpw += (lmax - 1 - edges[-1]) // (edges[-1] - edges[-2])
+        return nbpw
+    if bpw_edges is None:
+        return None
+    return lmax // int(bpw_edges)
@@ -1,31 +1,100 @@
 from bbpipe import PipelineStage
-from .types import FitsFile,YamlFile,DummyFile,TextFile
+from .types import TextFile,SACCFile
+from .power_summarizer import BBPowerSummarizer
+from .gaussian import linear_combination_covariance
+import sacc
+import numpy as np
 
-class BBCovFeFe(PipelineStage):
+class BBCovFeFe(BBPowerSummarizer):
     """
-    Template for a covariance matrix stage
+    Analytic (Gaussian) covariance of the coadded cross-split power spectra.
+    The covariance of the power spectra of all splits in each bandpower is
+    computed from the fiducial signal and the noise of the data (see
+    BBPowerSummarizer.get_model_spectra), with the number of modes given by
+    the bandpower windows and the effective sky fraction of the masks in
+    the masks_file option, and propagated to the coadded power spectra. The output has the same
+    tracers, binning and mean as the 'cells_coadded' output of
+    BBPowerSummarizer, and can be used by BBCompSep through its
+    'covariance_file' option.
     """
     name="BBCovFeFe"
-    inputs=[('splits_info',YamlFile),('simulation_info',YamlFile),
-            ('mode_coupling_matrix',DummyFile)]
-    outputs=[('sims_powspec_list',TextFile),('covariance_matrix',DummyFile)]
-    #Should we add a transfer function here?
-    config_options={'bpw_edges':[90,110,130],
-                    'beam_correct':True,
-                    'analytic_covariance':False}
+    inputs=[('splits_list',TextFile),('bandpasses_list',TextFile),('cells_fiducial',SACCFile),
+            ('cells_all_splits',SACCFile)]
+    outputs=[('covariance_matrix',SACCFile)]
+    config_options={'masks_file': None}
+    # Rough cost model (see estimate_resources)
+    cost_coefficients={'delta_ell':10,       # bandpower width, if bpw_edges isn't given
+                       'covar_time':1e-9,    # s per n_bpws*ncoadd*nmaps^3
+                       'base_memory':5e8}
+
+    @classmethod
+    def estimate_resources(cls, config, files, coefficients):
+        # Computing the covariance of each coadded power spectrum takes
+        # two products of matrices of the size of the number of maps
+        # for each bandpower. The weights of all maps for each coadded
+        # power spectrum and the output take most of the memory.
+        from .costs import n_bandpowers
+        c = coefficients
+        nside = config.get('nside')
+        nbands = cls.count_items(files.get('bandpasses_list'))
+        nsplits = cls.count_items(files.get('splits_list'))
+        if None in (nside, nbands, nsplits):
+            return None
+        nbpw = n_bandpowers(nside, config.get('bpw_edges', c['delta_ell']))
+        if nbpw is None:
+            return None
+        nmaps = 2*nbands*nsplits
+        ncoadd = (2*nbands*(2*nbands+1))//2
+        cpu_time = 2*nbpw*ncoadd*nmaps**3*c['covar_time']
+        memory = c['base_memory'] + 8*(3*ncoadd*nmaps**2 + (ncoadd*nbpw)**2)
+        return {'cpu_time':cpu_time, 'memory':memory, 'max_nprocess':1}
+
+    def get_coadd_weights(self):
+        """
+        Weights of the power spectra of all maps (split, band, polarization)
+        in each element of the coadded cross-split data vector (for a single
+        bandpower), in the form [ncoadd,nmaps,nmaps]. As in coadd_spectra,
+        each element is the mean over all pairs of different splits (i<j)
+        of the corresponding cross-spectrum.
+        """
+        i_x,j_x=np.triu_indices(self.nsplits,1)
+        iu=np.triu_indices(2*self.nbands)
+        ncoadd=len(iu[0])
+        weights=np.zeros([ncoadd,self.nsplits,2*self.nbands,self.nsplits,2*self.nbands])
+        weights[np.arange(ncoadd)[:,None],i_x[None,:],iu[0][:,None],
+                j_x[None,:],iu[1][:,None]]=1./len(i_x)
+        nmaps=self.nsplits*self.nbands*2
+        return weights.reshape([ncoadd,nmaps,nmaps])
+
+    def get_covariance(self):
+        """
+        Covariance of the coadded cross-split data vector, which is
+        block-diagonal in bandpowers.
+        """
+        print("Computing covariance for %d bandpowers"%(self.n_bpws))
+        cov_bpw=linear_combination_covariance(self.get_model_covariance(),
+                                              self.get_bandpower_modes(),
+                                              self.get_coadd_weights())
+        ncoadd=cov_bpw.shape[-1]
+        # Data vectors are ordered as [ncoadd,n_bpws]
+        cov=np.zeros([ncoadd,self.n_bpws,ncoadd,self.n_bpws])
+        for b in range(self.n_bpws):
+            cov[:,b,:,b]=cov_bpw[b]
+        return cov.reshape([ncoadd*self.n_bpws,ncoadd*self.n_bpws])
 
     def run(self) :
-        #This stage currently does nothing whatsoever
-        print(self.config)
-        for inp,_ in self.inputs :
-            fname=self.get_input(inp)
-            print("Reading "+fname)
-            open(fname)
-
-        for out,_ in self.outputs :
-            fname=self.get_output(out)
-            print("Writing "+fname)
-            open(fname,"w")
+        print("Init")
+        self.init_params()
+        self.get_tracers(self.s_splits)
+        self.get_binnings()
+        _,sv_cd_x,_,_=self.parse_splits_sacc_file(self.s_splits)
+
+        cov=self.get_covariance()
+
+        print("Writing output")
+        self.save_to_sacc(self.get_output("covariance_matrix"),
+                          self.t_coadd,self.bins_coadd,sv_cd_x,
+                          cov=sacc.Precision(matrix=cov,is_covariance=True,mode="dense"))
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
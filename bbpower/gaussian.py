@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def effective_fsky(mask):
+    """
+    Effective sky fraction of a mask (or of each row of a set of masks)
+    for the variance of its power spectra, w2^2/w4.
+    """
+    mask = np.atleast_2d(mask)
+    return np.mean(mask**2, axis=-1)**2/np.mean(mask**4, axis=-1)
+
+
+def bandpower_modes(ls, windows, fsky):
+    """
+    Effective number of independent modes in each bandpower, given its
+    window functions ([n_bpws, n_ell], sampled at multipoles `ls`). For
+    top-hat windows of width Delta this is fsky*(2*l+1)*Delta.
+    """
+    sum_w = np.sum(windows, axis=-1)
+    sum_w2 = np.sum(windows**2, axis=-1)
+    return fsky*np.sum(windows*(2*ls+1), axis=-1)*sum_w/sum_w2
+
+
+def matrix_sqrt(cov):
+    """
+    Return L such that L L^T = cov for a stack of symmetric matrices,
+    setting any negative eigenvalues to zero.
+    """
+    eigval, eigvec = np.linalg.eigh(cov)
+    return eigvec*np.sqrt(np.maximum(eigval, 0))[..., None, :]
+
+
+def draw_sample_covariances(cov, nu, nsamples, rng, max_size=20000000):
+    """
+    Draw realizations of the covariance estimated from nu (not necessarily
+    an integer) independent Gaussian modes with covariance `cov`, for each
+    of a stack of matrices ([n_bpws, nmaps, nmaps], with one value of nu
+    each). Returns an array of shape [nsamples, n_bpws, nmaps, nmaps].
+
+    These follow a Wishart distribution, which is sampled through its
+    Bartlett decomposition, so the cost doesn't depend on nu. Bandpowers
+    with fewer modes than maps are sampled by drawing the modes directly.
+    Samples are generated in chunks of at most max_size numbers.
+    """
+    nbpw, nmaps, _ = cov.shape
+    nu = np.broadcast_to(np.asarray(nu, dtype=float), (nbpw,))
+    sqrt_cov = matrix_sqrt(cov)
+    out = np.zeros([nsamples, nbpw, nmaps, nmaps])
+
+    bartlett = nu > nmaps-1
+    ib = np.flatnonzero(bartlett)
+    chunk = max(1, max_size//max(1, len(ib)*nmaps*nmaps))
+    il = np.tril_indices(nmaps, -1)
+    for i0 in range(0, nsamples, chunk):
+        ns = min(chunk, nsamples-i0)
+        a = np.zeros([ns, len(ib), nmaps, nmaps])
+        a[..., il[0], il[1]] = rng.standard_normal((ns, len(ib), len(il[0])))
+        df = nu[ib][None, :, None]-np.arange(nmaps)[None, None, :]
+        a[..., np.arange(nmaps), np.arange(nmaps)] = np.sqrt(
+            rng.chisquare(np.broadcast_to(df, (ns, len(ib), nmaps))))
+        la = np.matmul(sqrt_cov[ib], a)
+        out[i0:i0+ns, ib] = (np.matmul(la, np.swapaxes(la, -1, -2)) /
+                             nu[ib][None, :, None, None])
+
+    for b in np.flatnonzero(~bartlett):
+        nmodes = max(1, int(np.round(nu[b])))
+        x = np.matmul(rng.standard_normal((nsamples, nmodes, nmaps)),
+                      sqrt_cov[b].T)
+        out[:, b] = np.matmul(np.swapaxes(x, -1, -2), x)/nmodes
+    return out
+
+
+def linear_combination_covariance(cov, nu, weights):
+    """
+    Covariance of the linear combinations X_k = sum_ij weights[k,i,j]*C_ij
+    of the covariance C estimated from nu independent Gaussian modes with
+    covariance `cov`, for each of a stack of matrices ([n_bpws, nmaps,
+    nmaps], with one value of nu each). Since
+    <dC_ij dC_mn> = (cov_im*cov_jn + cov_in*cov_jm)/nu, this is
+    sum_ij weights[k,i,j]*(cov (W_l+W_l^T) cov)_ij/nu for all pairs (k,l)
+    at once. Returns an array of shape [n_bpws, ncomb, ncomb].
+    """
+    nbpw = len(cov)
+    ncomb = len(weights)
+    nu = np.broadcast_to(np.asarray(nu, dtype=float), (nbpw,))
+    w_flat = weights.reshape([ncomb, -1])
+    w_sym = weights+np.swapaxes(weights, -1, -2)
+    out = np.zeros([nbpw, ncomb, ncomb])
+    for b in range(nbpw):
+        g = np.matmul(np.matmul(cov[b], w_sym), cov[b])
+        out[b] = np.dot(w_flat, g.reshape([ncomb, -1]).T)/nu[b]
+    return out
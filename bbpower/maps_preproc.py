@@ -1,5 +1,6 @@
 from bbpipe import PipelineStage
 from .types import FitsFile, YamlFile, DummyFile
+from .partial_sky import read_maps
 import yaml
 import numpy as np
 
@@ -10,7 +11,55 @@ class BBMapsPreproc(PipelineStage):
     name="BBMapsPreproc"
     inputs=[('splits_info',YamlFile),('window_function',FitsFile)]
     outputs=[('nmt_fields',DummyFile)]
-    config_options={'purify_b':False}
+    config_options={'purify_b':False,
+                    'streaming':False,
+                    'map_dtype':'float64',
+                    'partial_sky':False}
+
+    def get_split_fname(self,cfg_maps,inu,isplit) :
+        size_info=cfg_maps['DataSize']
+        fname=cfg_maps['Maps']['prefix']
+        fname+="_split%dof%d_nu%dof%d.fits"%(isplit+1,size_info['nsplits'],
+                                             inu+1,size_info['nfreq'])
+        return fname
+
+    def run_streaming(self,cfg_maps,window) :
+        """
+        Process the maps one (band, split) at a time, writing each of them
+        to the output (an HDF5 file) as soon as it is ready, so that memory
+        scales with a single map. The Q and U maps of each band and split
+        are rows 2*(inu*n_splits+isplit) and the next one of the 'maps'
+        dataset, stored with type `map_dtype`. If `partial_sky` is True,
+        only the pixels where the window function is non-zero (listed in
+        the 'pixels' dataset) are stored. This is the format read by
+        read_maps (see PartialSkyMaps).
+        """
+        import h5py
+        size_info=cfg_maps['DataSize']
+        n_splits=size_info['nsplits']
+        n_nu=size_info['nfreq']
+        dtype=np.dtype(self.config['map_dtype'])
+
+        if self.config['partial_sky'] :
+            pixels=np.flatnonzero(window)
+        else :
+            pixels=None
+        npix_out=len(window) if pixels is None else len(pixels)
+
+        with h5py.File(self.get_output('nmt_fields'),'w') as f :
+            f.attrs['nside']=size_info['nside']
+            if pixels is not None :
+                f.create_dataset('pixels',data=pixels)
+            maps=f.create_dataset('maps',(n_nu*n_splits*2,npix_out),dtype=dtype)
+            for inu in range(n_nu) :
+                for isplit in range(n_splits) :
+                    fname=self.get_split_fname(cfg_maps,inu,isplit)
+                    print("Reading split: "+fname)
+                    mps=read_maps(fname,field=[1,2],pixels=pixels,dtype=dtype)
+                    #Processing of each map (purification, filtering, etc.)
+                    #would go here. For now we don't do anything at all.
+                    irow=2*(inu*n_splits+isplit)
+                    maps[irow:irow+2,:]=mps
 
     def run(self) :
         import healpy as hp #We will be more general than just assuming HEALPix
@@ -22,22 +71,23 @@ class BBMapsPreproc(PipelineStage):
         n_nu=size_info['nfreq']
 
         #Read window function
-        window=hp.read_map(self.get_input('window_function'),verbose=False)
+        window=read_maps(self.get_input('window_function'))
         if len(window)!=npix :
             raise ValueError("Window function has wrong pixelization")
 
+        if self.config['streaming'] :
+            self.run_streaming(cfg_maps,window)
+            return
+
         #Read maps
         #Map dimensions: [n_nu, n_splits, n_pol, n_pix]
-        maps_all=np.zeros([n_nu,n_splits,2,npix])
+        maps_all=np.zeros([n_nu,n_splits,2,npix],dtype=self.config['map_dtype'])
 
         for inu in range(n_nu) :
             for isplit in range(n_splits) :
-                fname=cfg_maps['Maps']['prefix']
-                fname+="_split%dof%d_nu%dof%d.fits"%(isplit+1,n_splits,
-                                                     inu+1,n_nu)
+                fname=self.get_split_fname(cfg_maps,inu,isplit)
                 print("Reading split: "+fname)
-                maps_all[inu,isplit,:,:]=np.array(hp.read_map(fname,verbose=False,
-                                                              field=[1,2]))
+                maps_all[inu,isplit,:,:]=read_maps(fname,field=[1,2])
 
         #Now we want to do stuff with the maps (purify, filter, etc.)
         #For now we don't do anything at all
@@ -1,10 +1,112 @@
 from bbpipe import PipelineStage
 from .types import FitsFile, TextFile
+from .partial_sky import read_maps
 import numpy as np
 
+def apodization_profile(dist,aposize,apotype) :
+    """
+    Value of the window function at an angular distance `dist` from the
+    masked region, for an apodization scale `aposize` (both in radians).
+    As in NaMaster, C1 and C2 apodization are functions of
+    x=sqrt((1-cos(dist))/(1-cos(aposize))), and are 1 for dist>aposize.
+    """
+    x=np.sqrt((1-np.cos(np.minimum(dist,aposize)))/(1-np.cos(aposize)))
+    if apotype=='C1' :
+        return x-np.sin(2*np.pi*x)/(2*np.pi)
+    elif apotype=='C2' :
+        return 0.5*(1-np.cos(np.pi*x))
+    raise ValueError("Unknown apodization type "+apotype)
+
+def apodize(dist,aposize,apotype,nside) :
+    """
+    Return the window function for the given angular distance of each
+    pixel to the masked region (0 inside it, np.inf far from it).
+    Smooth apodization (as in NaMaster) sets to zero all pixels within
+    2.5*aposize of the masked region, smooths the result with a Gaussian
+    beam of FWHM aposize and then sets the masked region to zero.
+    """
+    if apotype=='Smooth' :
+        import healpy as hp
+        window=hp.smoothing((dist>2.5*aposize).astype(float),fwhm=aposize)
+        return window*(dist>0)
+    return apodization_profile(dist,aposize,apotype)
+
+def chord_to_angle(chord) :
+    return 2*np.arcsin(np.minimum(chord/2,1))
+
+def angle_to_chord(angle) :
+    return 2*np.sin(np.minimum(angle,np.pi)/2)
+
+def apodization_range(aposize,apotype) :
+    # Largest distance to the masked region that affects the window function
+    return 2.5*aposize if apotype=='Smooth' else aposize
+
+def distance_to_edges(mask,max_dist) :
+    """
+    Return the angular distance (in radians) from each pixel to the
+    closest pixel outside the (binary) mask, or np.inf if it is farther
+    than max_dist. This is a distance transform on the sphere, computed
+    by querying a KD-tree of the masked pixels on the edge of the mask.
+    """
+    import healpy as hp
+    from scipy.spatial import cKDTree
+    nside=hp.npix2nside(len(mask))
+    inside=mask>0
+    ipix=np.flatnonzero(inside)
+
+    dist=np.zeros(len(mask))
+    # Masked pixels neighbouring the mask
+    neighbours=hp.get_all_neighbours(nside,ipix).flatten()
+    neighbours=neighbours[neighbours>=0]
+    edge=np.unique(neighbours[~inside[neighbours]])
+    if len(edge)==0 :
+        dist[ipix]=np.inf
+        return dist
+
+    tree=cKDTree(np.transpose(hp.pix2vec(nside,edge)))
+    chord,_=tree.query(np.transpose(hp.pix2vec(nside,ipix)),
+                       distance_upper_bound=angle_to_chord(max_dist))
+    dist[ipix]=chord_to_angle(chord)
+    return dist
+
+def distance_to_sources(mask,ra,dec,radius,max_dist) :
+    """
+    Return the angular distance (in radians) from each pixel inside the
+    mask to the edge of the closest source hole (0 inside the holes),
+    or np.inf if it is farther than max_dist. Sources are given by their
+    coordinates and radius (in degrees). The pixels near each source are
+    found in a single query of a KD-tree of the pixels in the mask.
+    """
+    import healpy as hp
+    from scipy.spatial import cKDTree
+    nside=hp.npix2nside(len(mask))
+    ipix=np.flatnonzero(mask>0)
+    dist=np.full(len(mask),np.inf)
+    if len(ra)==0 :
+        return dist
+
+    pix_vec=np.transpose(hp.pix2vec(nside,ipix))
+    src_vec=np.atleast_2d(hp.ang2vec(ra,dec,lonlat=True))
+    radius=np.radians(radius)
+    tree=cKDTree(pix_vec)
+    near=tree.query_ball_point(src_vec,angle_to_chord(radius+max_dist))
+
+    # Distance to the edge of each source for all (pixel, source) pairs
+    n_near=np.array([len(n) for n in near])
+    i_near=np.concatenate([np.array(n,dtype=int) for n in near])
+    i_src=np.repeat(np.arange(len(src_vec)),n_near)
+    cos_angle=np.sum(pix_vec[i_near]*src_vec[i_src],axis=1)
+    d=np.maximum(np.arccos(np.clip(cos_angle,-1,1))-radius[i_src],0)
+
+    dist_in=np.full(len(ipix),np.inf)
+    np.minimum.at(dist_in,i_near,d)
+    dist[ipix]=dist_in
+    return dist
+
 class BBMaskPreproc(PipelineStage):
     """
-    Template for a mask pre-processing stage
+    Mask pre-processing stage: apodizes the edges of the binary mask,
+    and masks and apodizes point sources.
     """
     name='BBMaskPreproc'
     inputs= [('binary_mask',FitsFile),('source_data',TextFile)]
@@ -14,22 +116,39 @@ class BBMaskPreproc(PipelineStage):
                     'aposize_srcs':0.1,
                     'apotype_srcs':'C1'}
 
+    def apodize_edges(self,mask) :
+        import healpy as hp
+        aposize=np.radians(self.config['aposize_edges'])
+        apotype=self.config['apotype_edges']
+        dist=distance_to_edges(mask,apodization_range(aposize,apotype))
+        return apodize(dist,aposize,apotype,hp.npix2nside(len(mask)))
+
+    def mask_sources(self,mask,ra,dec,size) :
+        import healpy as hp
+        aposize=np.radians(self.config['aposize_srcs'])
+        apotype=self.config['apotype_srcs']
+        dist=distance_to_sources(mask,ra,dec,size/60.,
+                                 apodization_range(aposize,apotype))
+        return apodize(dist,aposize,apotype,hp.npix2nside(len(mask)))
+
     def run(self) :
         #Read input mask
         import healpy as hp #We will want to be more general than assuming HEALPix
-        mask_raw=hp.read_map(self.get_input('binary_mask'),verbose=False)
+        mask_raw=read_maps(self.get_input('binary_mask'))
 
         #Read point source data
         #Right now this is a simple text file, but this is probably not ideal.
+        #Source sizes are the radii of the holes, in arcmin.
         ps_ra,ps_dec,ps_size=np.loadtxt(self.get_input('source_data'),unpack=True,ndmin=2)
 
-        #Now we should do stuff (apodization, inverse-variance weighting etc.)
-        #but this is just a placeholder
-        print("BBMaskPreproc currently does nothing")
+        #Apodize the edges of the mask and mask point sources
+        print("Apodizing mask edges")
+        window=self.apodize_edges(mask_raw)
+        print("Masking %d point sources" % len(ps_ra))
+        window*=self.mask_sources(mask_raw,ps_ra,ps_dec,ps_size)
 
         #Write window function
-        #Currently just writing the input mask.
-        hp.write_map(self.get_output('window_function'),mask_raw,overwrite=True)
+        hp.write_map(self.get_output('window_function'),window,overwrite=True)
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
@@ -0,0 +1,118 @@
+from bbpipe import PipelineStage
+from .types import TextFile,SACCFile
+from .power_summarizer import BBPowerSummarizer
+import sacc
+import numpy as np
+
+class BBNullTester(BBPowerSummarizer):
+    """
+    Null tests: chi^2 and probability to exceed (PTE) of all the null
+    power spectra computed by BBPowerSummarizer, and of all of them
+    combined for each null (i.e. each choice of split differences), with
+    covariances and PTEs estimated from the simulations (or fast mocks,
+    see BBPowerSummarizer.get_fast_mocks).
+    """
+    name="BBNullTester"
+    inputs=[('splits_list',TextFile),('bandpasses_list',TextFile),('cells_fiducial',SACCFile),
+            ('cells_all_splits',SACCFile),('cells_all_sims',TextFile)]
+    outputs=[('null_statistics',TextFile)]
+    config_options={'fast_mocks': 0,
+                    'fast_mocks_seed': None,
+                    'masks_file': None,
+                    'pte_threshold': 0.05}
+
+    def get_null_spectra(self,v):
+        """
+        Reshape null data vectors ([...,ndata]) into the form
+        [...,n_nulls*(2*nbands)^2,n_ell], with one row per null spectrum.
+        """
+        return v.reshape(v.shape[:-1]+(self.n_nulls*(2*self.nbands)**2,self.n_bpws))
+
+    def get_chi2(self,data,sims):
+        """
+        Returns the chi^2 of the data and of each simulation for all null
+        spectra at once (given as [nspec,n_ell] and [nsims,nspec,n_ell]),
+        with the covariance of each spectrum estimated from the simulations.
+        """
+        nsims=len(sims)
+        if nsims<=self.n_bpws+2:
+            raise ValueError("Need more than %d simulations to estimate the null covariances"%
+                             (self.n_bpws+2))
+        dsims=sims-np.mean(sims,axis=0)
+        cov=np.einsum('sia,sib->iab',dsims,dsims)/(nsims-1)
+        # Hartlap correction to the inverse covariances
+        icov=np.linalg.inv(cov)*(nsims-self.n_bpws-2)/(nsims-1)
+        chi2_data=np.sum(data*np.matmul(icov,data[:,:,None])[:,:,0],axis=-1)
+        chi2_sims=np.sum(sims*np.matmul(icov[None,:,:,:],sims[:,:,:,None])[:,:,:,0],axis=-1)
+        return chi2_data,chi2_sims
+
+    def get_null_names(self):
+        """
+        Names of all nulls (e.g. '1m2x3m4' for (m_1-m_2) x (m_3-m_4)) and
+        of all spectra of each of them (e.g. 'band1_E x band2_B').
+        """
+        nulls=['%dm%dx%dm%d'%(i+1,j+1,k+1,l+1) for i,j,k,l in self.pairings]
+        spectra=[]
+        for b1 in range(self.nbands):
+            for p1 in self.pol_names:
+                for b2 in range(self.nbands):
+                    for p2 in self.pol_names:
+                        spectra.append('band%d_%s x band%d_%s'%(b1+1,p1,b2+1,p2))
+        return nulls,spectra
+
+    def write_table(self,fname,nulls,spectra,chi2,ndof,pte):
+        with open(fname,'w') as f:
+            f.write("# null spectrum chi2 ndof pte\n")
+            for n,s,c,d,p in zip(nulls,spectra,chi2,ndof,pte):
+                f.write("%s '%s' %.3lf %d %.4lf\n"%(n,s,c,d,p))
+
+    def run(self):
+        print("Init")
+        self.init_params()
+
+        print("Reading data")
+        _,_,_,sv_null=self.parse_splits_sacc_file(self.s_splits)
+        data=self.get_null_spectra(sv_null.vector)
+
+        if self.config['fast_mocks']:
+            print("Generating %d fast mocks"%(self.config['fast_mocks']))
+            sims=self.get_fast_mocks(self.config['fast_mocks'])[3]
+        else:
+            print("Reading simulations")
+            self.read_sims_list()
+            sims=np.zeros([self.nsims,len(sv_null.vector)])
+            for i,fn in enumerate(self.fname_sims):
+                print(fn)
+                s=sacc.SACC.loadFromHDF(fn)
+                sims[i,:]=self.parse_splits_sacc_file(s)[3].vector
+        sims=self.get_null_spectra(sims)
+
+        print("Computing statistics")
+        # Individual null spectra
+        chi2_data,chi2_sims=self.get_chi2(data,sims)
+        # All spectra of each null, combined as if they were independent.
+        # The PTEs from the simulations account for their correlations.
+        chi2_data_all=np.sum(chi2_data.reshape([self.n_nulls,-1]),axis=-1)
+        chi2_sims_all=np.sum(chi2_sims.reshape([len(sims),self.n_nulls,-1]),axis=-1)
+        pte=np.mean(chi2_sims>=chi2_data[None,:],axis=0)
+        pte_all=np.mean(chi2_sims_all>=chi2_data_all[None,:],axis=0)
+
+        names_nulls,names_spectra=self.get_null_names()
+        nspec=len(names_spectra)
+        nulls=np.repeat(names_nulls,nspec).tolist()+names_nulls
+        spectra=names_spectra*self.n_nulls+['all']*self.n_nulls
+        chi2=np.concatenate([chi2_data,chi2_data_all])
+        ndof=[self.n_bpws]*len(chi2_data)+[nspec*self.n_bpws]*self.n_nulls
+        self.write_table(self.get_output('null_statistics'),nulls,spectra,
+                         chi2,ndof,np.concatenate([pte,pte_all]))
+
+        # Summary
+        thr=self.config['pte_threshold']
+        print("%d nulls with %d spectra each, %d simulations"%(self.n_nulls,nspec,len(sims)))
+        print(" Spectra with PTE < %.3lf: %d (%.1lf expected)"%
+              (thr,np.sum(pte<thr),thr*len(pte)))
+        print(" Nulls with PTE < %.3lf: %d (%.1lf expected)"%
+              (thr,np.sum(pte_all<thr),thr*len(pte_all)))
+
+if __name__ == '__main__':
+    cls = PipelineStage.main()
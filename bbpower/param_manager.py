@@ -69,18 +69,86 @@ class ParameterManager(object):
                     i_bps += 1
 
         self.p0 = np.array(self.p0)
+        self._compile_parameters()
+
+    def _compile_parameters(self):
+        # All parameters (fixed and free) are stored in a single vector,
+        # and can be looked up through their index in it (see `index`).
+        self.p_index = {}
+        for p_name in [n for n, _ in self.p_fixed] + self.p_free_names:
+            if p_name not in self.p_index:
+                self.p_index[p_name] = len(self.p_index)
+        self.p_all0 = np.zeros(len(self.p_index))
+        for p_name, v in self.p_fixed:
+            self.p_all0[self.p_index[p_name]] = float(v)
+        self.i_free = np.array([self.p_index[n] for n in self.p_free_names], dtype=int)
+
+        # Priors. Indices are into the vector of free parameters, and
+        # Gaussian priors have infinite edges.
+        is_gaussian = np.array([pr[1] == 'Gaussian' for pr in self.p_free_priors], dtype=bool)
+        self.i_gaussian = np.where(is_gaussian)[0]
+        self.i_tophat = np.where(~is_gaussian)[0]
+        self.prior_mean = np.array([float(self.p_free_priors[i][2][0]) for i in self.i_gaussian])
+        self.prior_sigma = np.array([float(self.p_free_priors[i][2][1]) for i in self.i_gaussian])
+        self.prior_lo = np.full(len(self.p_free_names), -np.inf)
+        self.prior_hi = np.full(len(self.p_free_names), np.inf)
+        for i in self.i_tophat:
+            self.prior_lo[i] = float(self.p_free_priors[i][2][0])
+            self.prior_hi[i] = float(self.p_free_priors[i][2][2])
+
+    def index(self, p_name):
+        """
+        Returns the position of a parameter in the vectors returned by
+        `build_params`.
+        """
+        try:
+            return self.p_index[p_name]
+        except KeyError:
+            raise KeyError("Unknown parameter %s" % p_name)
 
     def build_params(self, par):
-        params = dict(self.p_fixed)
-        params.update(dict(zip(self.p_free_names, par)))
+        """
+        Returns the vector of all (fixed and free) parameters, given the
+        free ones. `par` can also be a batch of shape [..., n_free].
+        """
+        par = np.asarray(par)
+        if par.ndim == 1:
+            params = self.p_all0.copy()
+        else:
+            params = np.empty(par.shape[:-1] + self.p_all0.shape)
+            params[...] = self.p_all0
+        params[..., self.i_free] = par
         return params
 
     def lnprior(self, par):
-        lnp = 0
-        for p, pr in zip(par, self.p_free_priors):
-            if pr[1] == 'Gaussian': #Gaussian prior
-                lnp += -0.5 * ((p - pr[2][0])/pr[2][1])**2
-            else: #Only other option is top-hat
-                if not(float(pr[2][0]) <= p <= float(pr[2][2])):
-                    return -np.inf
-        return lnp
+        """
+        Log-prior of the free parameters `par`, which can also be a
+        batch of shape [..., n_free].
+        """
+        par = np.asarray(par, dtype=float)
+        if par.ndim == 1:
+            if not ((par >= self.prior_lo).all() and (par <= self.prior_hi).all()):
+                return -np.inf
+            x = (par[self.i_gaussian] - self.prior_mean) / self.prior_sigma
+            return -0.5 * x.dot(x)
+        in_prior = np.all((par >= self.prior_lo) & (par <= self.prior_hi), axis=-1)
+        x = (par[..., self.i_gaussian] - self.prior_mean) / self.prior_sigma
+        return np.where(in_prior, -0.5 * np.sum(x**2, axis=-1), -np.inf)
+
+    def prior_transform(self, u):
+        """
+        Maps a point in the unit hypercube onto parameter space
+        (used by nested samplers). Top-hat priors must have finite edges.
+        """
+        from scipy.special import ndtri
+        lo = self.prior_lo[self.i_tophat]
+        hi = self.prior_hi[self.i_tophat]
+        finite = np.isfinite(lo) & np.isfinite(hi)
+        if not np.all(finite):
+            p_name = self.p_free_names[self.i_tophat[~finite][0]]
+            raise ValueError("Top-hat prior for %s must have finite edges" % p_name)
+        u = np.asarray(u, dtype=float)
+        par = np.empty(u.shape)
+        par[..., self.i_gaussian] = self.prior_mean + self.prior_sigma * ndtri(u[..., self.i_gaussian])
+        par[..., self.i_tophat] = lo + (hi - lo) * u[..., self.i_tophat]
+        return par
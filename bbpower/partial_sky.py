@@ -0,0 +1,116 @@
+import numpy as np
+
+
+class PartialSkyMaps(object):
+    """
+    A set of HEALPix maps stored only on a subset of pixels (e.g. those
+    inside the footprint of the experiment): an array of values with
+    shape [nmaps, npix_stored], and the (sorted) indices of those pixels.
+
+    In files (HDF5), these are the 'maps' and 'pixels' datasets, and the
+    resolution is stored in the 'nside' attribute. Files without 'pixels'
+    contain full-sky maps. This is also the format written by
+    BBMapsPreproc in streaming mode.
+    """
+    def __init__(self, nside, pixels, values):
+        self.nside = nside
+        self.pixels = pixels
+        self.values = values
+
+    @property
+    def npix(self):
+        return 12*self.nside**2
+
+    @property
+    def nmaps(self):
+        return len(self.values)
+
+    @classmethod
+    def from_full(cls, maps, pixels=None, dtype=None):
+        """
+        Create from one or several full-sky maps, keeping the given pixels
+        or, by default, those where any of the maps is non-zero.
+        """
+        maps = np.atleast_2d(maps)
+        nside = int(np.sqrt(maps.shape[1]//12))
+        if pixels is None:
+            pixels = np.flatnonzero(np.any(maps != 0, axis=0))
+        values = maps[:, pixels]
+        if dtype is not None:
+            values = values.astype(dtype)
+        return cls(nside, pixels, values)
+
+    def get(self, index=0, pixels=None, fill=0., dtype=np.float64):
+        """
+        Return the map(s) with the given index (or list of indices), either
+        full-sky or only on the given pixels, with `fill` in the pixels that
+        aren't stored. Only the requested maps are read from memory-mapped
+        files.
+        """
+        values = self.values[index]
+        if self.pixels is None:
+            if pixels is None:
+                return np.array(values, dtype=dtype)
+            return np.array(values[..., pixels], dtype=dtype)
+
+        npix_out = self.npix if pixels is None else len(pixels)
+        out = np.full(np.shape(values)[:-1]+(npix_out,), fill, dtype=dtype)
+        if pixels is None:
+            out[..., self.pixels] = values
+        else:
+            idx = np.searchsorted(self.pixels, pixels)
+            idx[idx == len(self.pixels)] = 0
+            found = self.pixels[idx] == pixels
+            out[..., found] = values[..., idx[found]]
+        return out
+
+    def write(self, fname):
+        import h5py
+        with h5py.File(fname, 'w') as f:
+            f.attrs['nside'] = self.nside
+            if self.pixels is not None:
+                f.create_dataset('pixels', data=self.pixels)
+            f.create_dataset('maps', data=self.values)
+
+    @classmethod
+    def read(cls, fname, mmap=True):
+        """
+        Read from a file. If `mmap` is True, the map values are memory-mapped
+        (if the file allows it), so that they are only read when needed.
+        """
+        import h5py
+        with h5py.File(fname, 'r') as f:
+            nside = int(f.attrs['nside'])
+            pixels = f['pixels'][...] if 'pixels' in f else None
+            ds = f['maps']
+            offset = ds.id.get_offset() if mmap else None
+            if offset is None:
+                values = ds[...]
+            else:
+                values = np.memmap(fname, mode='r', dtype=ds.dtype,
+                                   shape=ds.shape, offset=offset)
+        return cls(nside, pixels, values)
+
+
+def is_partial_sky_file(fname):
+    import h5py
+    return h5py.is_hdf5(fname)
+
+
+def read_maps(fname, field=0, pixels=None, dtype=np.float64):
+    """
+    Read the map(s) in the given field (or list of fields, or all of them
+    if None) of a HEALPix FITS file or of a partial-sky file (see
+    PartialSkyMaps), either full-sky or only on the given pixels.
+    """
+    if is_partial_sky_file(fname):
+        maps = PartialSkyMaps.read(fname)
+        if field is None:
+            field = slice(None) if maps.nmaps > 1 else 0
+        return maps.get(field, pixels=pixels, dtype=dtype)
+
+    import healpy as hp
+    maps = np.array(hp.read_map(fname, field=field, dtype=dtype))
+    if pixels is not None:
+        maps = maps[..., pixels]
+    return maps
@@ -8,6 +8,78 @@ import matplotlib.pyplot as plt
 import dominate as dom
 import dominate.tags as dtg
 import os
+import json
+import hashlib
+import pickle
+
+def get_errors(s):
+    """
+    Standard deviations of the data vector of a SACC file, from the
+    diagonal of its covariance (stored as a vector if it's diagonal).
+    The stored covariance is used directly, and only computed from the
+    precision matrix if that's all the file contains.
+    """
+    cov=getattr(s.precision,'cmatrix',None)
+    if cov is None:
+        cov=s.precision.getCovarianceMatrix()
+    if np.ndim(cov)==1:
+        return np.sqrt(cov)
+    return np.sqrt(np.diagonal(cov))
+
+def draw_bandpasses(ax,title,curves,ylim):
+    ax.set_title(title,fontsize=14)
+    for nu,bnu,label in curves:
+        ax.plot(nu,bnu/np.amax(bnu),label=label)
+    ax.set_xlabel('$\\nu\\,[{\\rm GHz}]$',fontsize=14)
+    ax.set_ylabel('Transmission',fontsize=14)
+    ax.set_ylim(ylim)
+    if curves[0][2] is not None:
+        ax.legend(frameon=0,ncol=2,labelspacing=0.1,loc='upper left')
+        ax.set_xscale('log')
+
+def draw_coadded(ax,title,ells,cf,ct,et,cn,cx):
+    # Signal, noise, total and fiducial model
+    ax.set_title(title,fontsize=14)
+    ax.plot(ells,cf,'k-',label='Fiducial model')
+    for cl,fmt,label in [(ct,'ro','Total coadd'),(cn,'yo','Noise'),(cx,'bo','Cross-coadd')]:
+        ax.errorbar(ells,cl,yerr=et,fmt=fmt,label=label)
+        eb=ax.errorbar(ells+1.,-cl,yerr=et,fmt=fmt,mfc='white')
+        eb[-1][0].set_linestyle('--')
+    ax.set_yscale('log')
+    ax.set_xlabel('$\\ell$',fontsize=15)
+    ax.set_ylabel('$C_\\ell$',fontsize=15)
+    ax.legend()
+
+def draw_nulls(ax,title,ells,spectra,colors):
+    # Null spectra in units of their standard deviation
+    ax.set_title(title,fontsize=15)
+    for typ,cl in spectra.items():
+        ax.errorbar(ells,cl,yerr=np.ones(len(cl)),fmt=colors[typ]+'-',label=typ)
+    ax.set_xlabel('$\\ell$',fontsize=15)
+    ax.set_ylabel('$C_\\ell/\\sigma_\\ell$',fontsize=15)
+    ax.legend()
+
+def plot_figure(task):
+    """
+    Render a plot, given as (file name, drawing function, panels). Panels
+    are the arguments of the drawing function: a single dictionary for
+    a single plot, or a list of them for a grid of plots.
+    """
+    fname,draw,panels=task
+    if isinstance(panels,dict):
+        fig,ax=plt.subplots()
+        draw(ax,**panels)
+    else:
+        ncols=int(np.ceil(np.sqrt(len(panels))))
+        nrows=int(np.ceil(len(panels)/ncols))
+        fig,axes=plt.subplots(nrows,ncols,figsize=(5*ncols,4*nrows),squeeze=False)
+        for ax,p in zip(axes.flatten(),panels):
+            draw(ax,**p)
+        for ax in axes.flatten()[len(panels):]:
+            ax.axis('off')
+        fig.tight_layout()
+    fig.savefig(fname,bbox_inches='tight')
+    plt.close(fig)
 
 class BBPlotter(PipelineStage):
     name="BBPlotter"
@@ -15,7 +87,71 @@ class BBPlotter(PipelineStage):
             ('cells_noise',SACCFile), ('cells_null',SACCFile), 
             ('cells_fiducial',SACCFile), ('param_chains',NpzFile)]
     outputs=[('plots',DirFile),('plots_page',HTMLFile)]
-    config_options={'lmax_plot':300}
+    config_options={'lmax_plot':300,
+                    'n_pool':1,
+                    'summary_plots':False,
+                    'summary_panels':16}
+
+    def render(self,tasks):
+        """
+        Render plots (see plot_figure) in a pool of n_pool processes,
+        skipping those whose content hasn't changed since they were last
+        rendered (as recorded by a hash of their inputs in the plots
+        directory).
+        """
+        fname_hashes=os.path.join(self.get_output('plots'),'plot_hashes.json')
+        hashes={}
+        if os.path.isfile(fname_hashes):
+            with open(fname_hashes) as f:
+                hashes=json.load(f)
+        todo=[]
+        for task in tasks:
+            fname,draw,panels=task
+            h=hashlib.sha1(pickle.dumps((draw.__name__,panels))).hexdigest()
+            if os.path.isfile(fname) and (hashes.get(fname)==h):
+                continue
+            todo.append(task)
+            hashes[fname]=h
+        print("Rendering %d plots (%d unchanged)"%(len(todo),len(tasks)-len(todo)))
+
+        if (self.config['n_pool']>1) and (len(todo)>1):
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self.config['n_pool']) as pool:
+                list(pool.map(plot_figure,todo))
+        else:
+            for task in todo:
+                plot_figure(task)
+
+        with open(fname_hashes,'w') as f:
+            json.dump(hashes,f)
+
+    def add_plots(self,lst,tasks,fname_summary,title_summary):
+        """
+        Render a list of plots (tuples of title, file name, drawing
+        function and panel) and add them to the page, or render them as
+        grids of at most summary_panels plots in summary mode.
+        """
+        if not tasks:
+            return
+        if self.config['summary_plots']:
+            _,_,draw,_=tasks[0]
+            n_panels=max(self.config['summary_panels'],1)
+            pages=[tasks[i:i+n_panels] for i in range(0,len(tasks),n_panels)]
+            if len(pages)>1:
+                root,ext=os.path.splitext(fname_summary)
+                fnames=[root+'_%d'%(i+1)+ext for i in range(len(pages))]
+                titles=[title_summary+' (%d/%d)'%(i+1,len(pages)) for i in range(len(pages))]
+            else:
+                fnames=[fname_summary]
+                titles=[title_summary]
+            self.render([(fname,draw,[p for _,_,_,p in page])
+                         for fname,page in zip(fnames,pages)])
+            for title,fname in zip(titles,fnames):
+                lst+=dtg.li(dtg.a(title,href=fname))
+        else:
+            self.render([(fname,draw,p) for _,fname,draw,p in tasks])
+            for title,fname,_,_ in tasks:
+                lst+=dtg.li(dtg.a(title,href=fname))
 
     def create_page(self):
         # Open plots directory
@@ -43,50 +179,40 @@ class BBPlotter(PipelineStage):
             # Overall plot
             title='Bandpasses summary'
             fname=self.get_output('plots')+'/bpass_summary.png'
-            plt.figure()
-            plt.title(title,fontsize=14)
+            curves=[]
             for t in self.s_fid.tracers:
                 n=t.name[2:-1]
                 nu_mean=np.sum(t.Nz*t.z**3*t.extra_cols['dnu'])/np.sum(t.Nz*t.z**2*t.extra_cols['dnu'])
-                plt.plot(t.z,t.Nz/np.amax(t.Nz),label=n+', $\\langle\\nu\\rangle=%.1lf\\,{\\rm GHz}$'%nu_mean)
-            plt.xlabel('$\\nu\\,[{\\rm GHz}]$',fontsize=14)
-            plt.ylabel('Transmission',fontsize=14)
-            plt.ylim([0.,1.3])
-            plt.legend(frameon=0,ncol=2,labelspacing=0.1,loc='upper left')
-            plt.xscale('log')
-            plt.savefig(fname,bbox_inches='tight')
-            plt.close()
+                curves.append((t.z,t.Nz,n+', $\\langle\\nu\\rangle=%.1lf\\,{\\rm GHz}$'%nu_mean))
+            self.render([(fname,draw_bandpasses,
+                          {'title':title,'curves':curves,'ylim':[0.,1.3]})])
             lst+=dtg.li(dtg.a(title,href=fname))
-            
+
+            tasks=[]
             for t in self.s_fid.tracers:
                 n=t.name[2:-1]
                 title='Bandpass '+n
                 fname=self.get_output('plots')+'/bpass_'+n+'.png'
-                plt.figure()
-                plt.title(title,fontsize=14)
-                plt.plot(t.z,t.Nz/np.amax(t.Nz))
-                plt.xlabel('$\\nu\\,[{\\rm GHz}]$',fontsize=14)
-                plt.ylabel('Transmission',fontsize=14)
-                plt.ylim([0.,1.05])
-                plt.savefig(fname,bbox_inches='tight')
-                plt.close()
-                lst+=dtg.li(dtg.a(title,href=fname))
+                tasks.append((title,fname,draw_bandpasses,
+                              {'title':title,'curves':[(t.z,t.Nz,None)],'ylim':[0.,1.05]}))
+            self.add_plots(lst,tasks,self.get_output('plots')+'/bpass_all.png',
+                           'All bandpasses')
             dtg.div(dtg.a('Back to TOC',href='#contents'))
 
     def add_coadded(self):
+        # Only the mean and the diagonal of the covariance are needed
         cls_f=self.s_fid.mean.vector
         cls_t=self.s_cd_t.mean.vector
-        els_t=np.sqrt(np.diag(self.s_cd_t.precision.getCovarianceMatrix()))
+        els_t=get_errors(self.s_cd_t)
         cls_x=self.s_cd_x.mean.vector
-        els_x=np.sqrt(np.diag(self.s_cd_x.precision.getCovarianceMatrix()))
         cls_n=self.s_cd_n.mean.vector
-        els_n=np.sqrt(np.diag(self.s_cd_n.precision.getCovarianceMatrix()))
 
         with self.doc:
             dtg.h2("Coadded power spectra",id='coadded')
             lst=dtg.ul()
             sorter=self.s_fid.sortTracers()
             # Loop over all possible power spectra
+            tasks=[]
             for t1,t2,typ,ells,ndx in sorter:
                 typ=typ.decode()
                 # Plot title
@@ -100,39 +226,15 @@ class BBPlotter(PipelineStage):
                 fname+="_x_"
                 fname+=self.s_cd_t.tracers[t2].name[2:-1]
                 fname+="_"+typ+".png"
-                print(fname)
-                cf=cls_f[ndx][self.msk]
-                ct=cls_t[ndx][self.msk]
-                et=els_t[ndx][self.msk]
-                cn=cls_n[ndx][self.msk]
-                en=els_n[ndx][self.msk]
-                cx=cls_x[ndx][self.msk]
-                ex=els_x[ndx][self.msk]
-                # For each combination, plot signal, noise, total and fiducial model
-                plt.figure()
-                plt.title(title,fontsize=14)
-                plt.plot(self.ells[self.msk],cf,'k-',label='Fiducial model')
-                plt.errorbar(self.ells[self.msk], ct,yerr=et,fmt='ro',
-                             label='Total coadd')
-                eb=plt.errorbar(self.ells[self.msk]+1.,-ct,yerr=et,fmt='ro',mfc='white')
-                eb[-1][0].set_linestyle('--')
-
-                plt.errorbar(self.ells[self.msk], cn,yerr=et,fmt='yo',
-                             label='Noise')
-                eb=plt.errorbar(self.ells[self.msk]+1.,-cn,yerr=et,fmt='yo',mfc='white')
-                eb[-1][0].set_linestyle('--')
-
-                plt.errorbar(self.ells[self.msk], cx,yerr=et,fmt='bo',
-                             label='Cross-coadd')
-                eb=plt.errorbar(self.ells[self.msk]+1.,-cx,yerr=et,fmt='bo',mfc='white')
-                eb[-1][0].set_linestyle('--')
-                plt.yscale('log')
-                plt.xlabel('$\\ell$',fontsize=15)
-                plt.ylabel('$C_\\ell$',fontsize=15)
-                plt.legend()
-                plt.savefig(fname,bbox_inches='tight')
-                plt.close()
-                lst+=dtg.li(dtg.a(title,href=fname))
+                panel={'title':title,'ells':self.ells[self.msk],
+                       'cf':cls_f[ndx][self.msk],
+                       'ct':cls_t[ndx][self.msk],
+                       'et':els_t[ndx][self.msk],
+                       'cn':cls_n[ndx][self.msk],
+                       'cx':cls_x[ndx][self.msk]}
+                tasks.append((title,fname,draw_coadded,panel))
+            self.add_plots(lst,tasks,self.get_output('plots')+'/cls_summary.png',
+                           'All coadded power spectra')
 
             dtg.div(dtg.a('Back to TOC',href='#contents'))
                 
@@ -147,9 +249,10 @@ class BBPlotter(PipelineStage):
             # Unique cross-correlations
             xc_un=np.unique(xcorrs)
 
-            cls_null=self.s_null.mean.vector
-            err_null=np.sqrt(self.s_null.precision.getCovarianceMatrix())
+            # Only the mean and the diagonal of the covariance are needed
+            cls_null=self.s_null.mean.vector/get_errors(self.s_null)
             # Loop over unique correlations
+            tasks=[]
             for comb in xc_un:
                 t1,t2=comb.split('_')
                 t1=int(t1)
@@ -166,24 +269,18 @@ class BBPlotter(PipelineStage):
                 fname+="_x_"
                 fname+=self.s_null.tracers[t2].name[2:-1]
                 fname+=".png"
-                print(fname)
 
-                # Plot all power spectra
-                plt.figure()
-                plt.title(title,fontsize=15)
+                # All power spectra
+                spectra={}
                 for ind in ind_spectra:
                     typ=sorter[ind][2].decode()
                     ndx=sorter[ind][4]
-                    plt.errorbar(self.ells[self.msk],
-                                 (cls_null[ndx]/err_null[ndx])[self.msk],
-                                 yerr=np.ones(len(ndx))[self.msk],
-                                 fmt=self.cols_typ[typ]+'-',label=typ)
-                plt.xlabel('$\\ell$',fontsize=15)
-                plt.ylabel('$C_\\ell/\\sigma_\\ell$',fontsize=15)
-                plt.legend()
-                plt.savefig(fname,bbox_index='tight')
-                plt.close()
-                lst+=dtg.li(dtg.a(title,href=fname))
+                    spectra[typ]=cls_null[ndx][self.msk]
+                panel={'title':title,'ells':self.ells[self.msk],
+                       'spectra':spectra,'colors':self.cols_typ}
+                tasks.append((title,fname,draw_nulls,panel))
+            self.add_plots(lst,tasks,self.get_output('plots')+'/cls_null_summary.png',
+                           'All null tests')
 
             dtg.div(dtg.a('Back to TOC',href='#contents'))
 
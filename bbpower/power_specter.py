@@ -1,5 +1,7 @@
 from bbpipe import PipelineStage
 from .types import FitsFile,TextFile,SACCFile,DummyFile
+from .partial_sky import read_maps
+from .windows import compress_window
 import sacc
 import numpy as np
 import healpy as hp
@@ -14,10 +16,40 @@ class BBPowerSpecter(PipelineStage):
     inputs=[('splits_list',TextFile),('masks_apodized',FitsFile),('bandpasses_list',TextFile),
             ('sims_list',TextFile),('beams_list',TextFile)]
     outputs=[('cells_all_splits',SACCFile),('cells_all_sims',TextFile),('mcm',DummyFile)]
+    # Simulations can be fanned out as separate tasks by the pipeline
+    map_input='sims_list'
+    map_output='cells_all_sims'
     config_options={'bpw_edges':None,
                     'beam_correct':True,
                     'purify_B':True,
                     'n_iter':3}
+    # Rough cost model (see estimate_resources)
+    cost_coefficients={'mcm_time':3e-8,     # s per lmax^3 for each MCM
+                       'field_time':4e-9,   # s per nside^3 for each field and SHT iteration
+                       'field_memory':100,  # bytes per pixel for each field
+                       'base_memory':5e8}
+
+    @classmethod
+    def estimate_resources(cls, config, files, coefficients):
+        # MCMs take O(lmax^3) operations and memory O(lmax^2), and
+        # each field of the data and the simulations takes n_iter+1
+        # spherical harmonic transforms. Simulations can be split
+        # across processes.
+        nside = config.get('nside')
+        nbands = cls.count_items(files.get('bandpasses_list'))
+        nsplits = cls.count_items(files.get('splits_list'))
+        nsims = cls.count_items(files.get('sims_list'))
+        if None in (nside, nbands, nsplits, nsims):
+            return None
+        c = coefficients
+        lmax = 3*nside
+        nfields = nbands*nsplits
+        nmcms = (nbands*(nbands+1))//2
+        cpu_time = (nmcms*c['mcm_time']*lmax**3 +
+                    (nsims+1)*nfields*(config['n_iter']+1)*c['field_time']*nside**3)
+        memory = (c['base_memory'] + nfields*12*nside**2*c['field_memory'] +
+                  nmcms*2*8*(4*lmax)**2)
+        return {'cpu_time':cpu_time, 'memory':memory, 'max_nprocess':max(nsims,1)}
 
     def init_params(self):
         self.nside = self.config['nside']
@@ -56,24 +88,120 @@ class BBPowerSpecter(PipelineStage):
                 fname = splits_list[s]
                 if not os.path.isfile(fname):  # See if it's gzipped
                     fname = fname + '.gz'
+                if not os.path.isfile(fname):  # Or a partial-sky file
+                    fname = os.path.splitext(splits_list[s])[0] + '.hdf'
                 if not os.path.isfile(fname):
                     raise ValueError("Can't find file ",splits_list[s])
-                mp_q,mp_u=hp.read_map(fname, field=[2*b,2*b+1], verbose=False)
+                mp_q,mp_u=read_maps(fname, field=[2*b,2*b+1])
                 fields[name] = self.get_field(b,[mp_q,mp_u])
 
-        # Iterate over field pairs
+        # Compute all cross-spectra at once
         print(" Computing cross-spectra")
-        cells = {}
+        return self.compute_cells_from_fields(fields)
+
+    def compute_coupled_cells(self, fields):
+        """
+        Compute the coupled power spectra of all pairs of fields at once.
+        The alms of all fields are gathered into a single array, sorted by
+        ell, so that for each ell the cross-spectra of all maps are given by
+        the real part of a matrix product over m.
+        Returns a dictionary with the index of the first map of each field,
+        and an array of spectra with shape [nmaps, nmaps, lmax+1].
+        """
+        names = list(fields.keys())
+        alms0 = fields[names[0]].get_alms()
+        npol, nalm = alms0.shape
+        lmax = int((np.sqrt(8*nalm+1)-3)/2)
+
+        # Order alms by ell (healpy's ordering is by m)
+        ell, m = hp.Alm.getlm(lmax)
+        order = np.lexsort((m, ell))
+        alms = np.zeros([len(names)*npol, nalm], dtype=alms0.dtype)
+        for i, n in enumerate(names):
+            alms[i*npol:(i+1)*npol] = fields[n].get_alms()[:, order]
+        m = m[order]
+
+        # Re(a1 a2^*) summed over m, with m>0 counted twice
+        cls = np.zeros([len(names)*npol, len(names)*npol, lmax+1])
+        start = 0
+        for l in range(lmax+1):
+            a = alms[:, start:start+l+1]
+            start += l+1
+            cl = 2*(a.real @ a.real.T + a.imag @ a.imag.T)
+            cl -= np.outer(a[:, 0].real, a[:, 0].real) + np.outer(a[:, 0].imag, a[:, 0].imag)
+            cls[:, :, l] = cl/(2*l+1)
+        return {n: i*npol for i, n in enumerate(names)}, cls
+
+    def get_decoupler(self, name):
+        """
+        Return the inverse of the binned MCM of a workspace, so that the
+        spectra of all field pairs sharing it can be decoupled at once, or
+        None if it doesn't reproduce decouple_cell.
+        """
+        if name in self.decouplers:
+            return self.decouplers[name]
+        wsp = self.workspaces[name]
+        nbpw = self.bins.get_n_bands()
+        nell = 3*self.nside
+
+        # decouple_cell(c) = M_b^-1 bin(c), so we recover M_b^-1 column by
+        # column from spectra whose binned version is a unit vector.
+        minv = np.zeros([4*nbpw, 4*nbpw])
+        for ib in range(nbpw):
+            ells = self.bins.get_ell_list(ib)
+            l = ells[np.argmax(self.bins.get_weight_list(ib))]
+            unit = np.zeros([4, nell])
+            unit[:, l] = 1
+            v = self.bins.bin_cell(unit)[0, ib]
+            for ip in range(4):
+                c = np.zeros([4, nell])
+                c[ip, l] = 1./v
+                minv[:, ip*nbpw+ib] = wsp.decouple_cell(c).flatten()
+
+        # Check it against decouple_cell for some random spectra
+        c = np.random.default_rng(1234).normal(size=[4, nell])
+        batched = minv @ self.bins.bin_cell(c).flatten()
+        if not np.allclose(batched, wsp.decouple_cell(c).flatten(), rtol=1e-6, atol=0):
+            print("  Can't batch the decoupling of workspace "+name)
+            minv = None
+        self.decouplers[name] = minv
+        return minv
+
+    def compute_cells_from_fields(self, fields):
+        nbpw = self.bins.get_n_bands()
+        if not all(hasattr(f, 'get_alms') for f in fields.values()):
+            # Older versions of NaMaster don't give access to the alms
+            cells = {}
+            for b1,b2,s1,s2,l1,l2 in self.get_cell_iterator():
+                wsp = self.workspaces[self.get_workspace_label(b1,b2)]
+                cells.setdefault(l1, {})[l2] = wsp.decouple_cell(
+                    nmt.compute_coupled_cell(fields[l1],fields[l2]))
+            return cells
+
+        index, cls = self.compute_coupled_cells(fields)
+
+        # Group field pairs by workspace
+        groups = {}
         for b1,b2,s1,s2,l1,l2 in self.get_cell_iterator():
-            wsp = self.workspaces[self.get_workspace_label(b1,b2)]
-            if cells.get(l1) is None: # Create sub-dictionary if it doesn't exist
-                cells[l1]={}
-            f1 = fields[l1]
-            f2 = fields[l2]
-            # Compute power spectrum
-            print("  "+l1+" "+l2)
-            cells[l1][l2] = wsp.decouple_cell(nmt.compute_coupled_cell(f1,f2))
+            groups.setdefault(self.get_workspace_label(b1,b2), []).append((l1,l2))
 
+        cells = {}
+        for name, pairs in groups.items():
+            # Coupled EE, EB, BE and BB spectra of each pair
+            coupled = np.array([[cls[index[l1]+p1, index[l2]+p2]
+                                 for p1 in range(2) for p2 in range(2)]
+                                for l1, l2 in pairs])
+            minv = self.get_decoupler(name)
+            if minv is None:
+                wsp = self.workspaces[name]
+                decoupled = [wsp.decouple_cell(c) for c in coupled]
+            else:
+                nell = coupled.shape[-1]
+                binned = self.bins.bin_cell(coupled.reshape([-1, nell]))
+                binned = binned.reshape([len(pairs), 4*nbpw])
+                decoupled = (binned @ minv.T).reshape([len(pairs), 4, nbpw])
+            for (l1, l2), cl in zip(pairs, decoupled):
+                cells.setdefault(l1, {})[l2] = cl
         return cells
 
     def read_bandpasses(self):
@@ -91,11 +219,42 @@ class BBPowerSpecter(PipelineStage):
             self.bpss['band%d' % (i_f+1)]={'nu':nu, 'dnu':dnu, 'bnu':bnu}
 
     def read_masks(self,nbands):
-        self.masks=[]
-        for i in range(nbands):
-            m=hp.read_map(self.get_input('masks_apodized'),
-                          verbose=False)
-            self.masks.append(hp.ud_grade(m,nside_out=self.nside))
+        # The masks file may contain a single mask for all bands, or
+        # one per band. Each distinct mask is degraded only once (and
+        # identical masks share the same array), and the degraded masks
+        # are cached next to the MCMs, keyed by the file contents and nside.
+        from bbpipe.provenance import hash_bytes
+        fname=self.get_input('masks_apodized')
+        fname_cache=self.prefix_mcm+"_masks_%s_ns%d.npz" % (hash_bytes(fname), self.nside)
+        if os.path.isfile(fname_cache):
+            print("Reading degraded masks from "+fname_cache)
+            with np.load(fname_cache) as f:
+                masks=f['masks']
+                columns=f['columns']
+        else:
+            import hashlib
+            distinct={}
+            masks=[]
+            columns=[]
+            for m in np.atleast_2d(read_maps(fname,field=None)):
+                key=hashlib.sha1(m.tobytes()).hexdigest()
+                if key not in distinct:
+                    distinct[key]=len(masks)
+                    masks.append(hp.ud_grade(m,nside_out=self.nside))
+                columns.append(distinct[key])
+            masks=np.array(masks)
+            columns=np.array(columns)
+            # Write atomically, since several processes may do this
+            fname_tmp=fname_cache+".tmp%d" % self.rank
+            with open(fname_tmp,'wb') as f:
+                np.savez(f,masks=masks,columns=columns)
+            os.replace(fname_tmp,fname_cache)
+
+        if len(columns)==1:
+            columns=np.zeros(nbands,dtype=int)
+        elif len(columns)!=nbands:
+            raise ValueError("Found %d masks for %d bands" % (len(columns),nbands))
+        self.masks=[masks[c] for c in columns]
 
     def get_bandpowers(self):
         # If it's a file containing the bandpower edges
@@ -174,6 +333,7 @@ class BBPowerSpecter(PipelineStage):
         #  but the same across polarization channels and splits.
         print("Estimating mode-coupling matrices")
         self.workspaces={}
+        self.decouplers={}
         for i1 in range(self.n_bpss):
             for i2 in range(i1,self.n_bpss):
                 name=self.get_workspace_label(i1,i2)
@@ -222,6 +382,10 @@ class BBPowerSpecter(PipelineStage):
                     windows_wsp[name]['BE'] = bpw_win[2,:,2,:]
                     windows_wsp[name]['BB'] = bpw_win[3,:,3,:]
             windows = []
+            # Windows only cover the multipoles where they're non-zero,
+            # and the same window object is used for all split pairs
+            # sharing a workspace
+            windows_sacc = {}
         
         for b1,b2,s1,s2,l1,l2 in self.get_cell_iterator():
             if (b1==b2) and (s1==s2):
@@ -239,12 +403,23 @@ class BBPowerSpecter(PipelineStage):
                     q1.append('C')
                     q2.append('C')
                     if with_windows:
-                        windows.append(sacc.Window(self.larr_all,
-                                                   windows_wsp[name_wsp][ty][il]))
+                        key = (name_wsp,ty,il)
+                        if key not in windows_sacc:
+                            windows_sacc[key] = compress_window(self.larr_all,
+                                                                windows_wsp[name_wsp][ty][il])
+                        windows.append(windows_sacc[key])
 
         return sacc.Binning(typ,ell,t1,q1,t2,q2,windows=windows)
 
-    def save_cell_to_file(self,cell,tracers,binning,fname):
+    def get_fname_sim(self,isim):
+        prefix_out=self.get_output('cells_all_splits')[:-5]
+        return prefix_out + "_sim%d.sacc" % isim
+
+    def get_sim_splits(self,d):
+        return [d+'/obs_split%dof%d.fits' % (i+1, self.nsplits)
+                for i in range(self.nsplits)]
+
+    def get_cell_vector(self,cell):
         # Create data vector
         vector = []
         for b1,b2,s1,s2,l1,l2 in self.get_cell_iterator():
@@ -254,12 +429,18 @@ class BBPowerSpecter(PipelineStage):
             if add_BE: #Only add B1E2 if 1!=2
                 vector.append(cell[l1][l2][2]) #BE
             vector.append(cell[l1][l2][3]) #BB
+        return np.array(vector).flatten()
 
-        sacc_mean = sacc.MeanVec(np.array(vector).flatten())
+    def save_vector_to_file(self,vector,tracers,binning,fname):
+        sacc_mean = sacc.MeanVec(vector)
         s=sacc.SACC(tracers,binning,sacc_mean)
         print("Saving to "+fname)
         s.saveToHDF(fname)
 
+    def save_cell_to_file(self,cell,tracers,binning,fname):
+        self.save_vector_to_file(self.get_cell_vector(cell),
+                                 tracers,binning,fname)
+
     def run(self) :
         self.init_params()
 
@@ -278,8 +459,14 @@ class BBPowerSpecter(PipelineStage):
         print("Reading masks")
         self.read_masks(self.n_bpss)
 
-        # Compute all possible MCMs
-        self.compute_workspaces()
+        # Compute all possible MCMs (under MPI, the root process computes
+        # and saves them before the others read them)
+        if self.rank==0:
+            self.compute_workspaces()
+        if self.is_mpi():
+            self.comm.Barrier()
+        if self.rank!=0:
+            self.compute_workspaces()
 
         # Compile list of splits
         splits = []
@@ -295,44 +482,35 @@ class BBPowerSpecter(PipelineStage):
         # Get SACC tracers
         self.tracers = self.get_sacc_tracers()
 
-        # Compute all possible cross-power spectra
-        print("Computing all cross-correlations")
-        cell_data = self.compute_cells_from_splits(splits)
-        
-        # Save output
-        print("Saving to file")
-        self.save_cell_to_file(cell_data,
-                               self.tracers,
-                               self.bin_win,
-                               self.get_output('cells_all_splits'))
-        
-        # Iterate over simulations
-        sims = []
-        with open(self.get_input('sims_list'),'r') as f:
-            for dname in f:
-                sims.append(dname.strip())
-
-        # Write all output file names into a text file
-        fo=open(self.get_output('cells_all_sims'),'w')
-        prefix_out=self.get_output('cells_all_splits')[:-5]
-        for isim,d in enumerate(sims):
-            fname=prefix_out + "_sim%d.sacc" % isim
-            fo.write(fname+"\n")
-        fo.close()
-
-        for isim,d in enumerate(sims):
-            print("%d-th / %d simulation" % (isim+1, len(sims)))
-            #   Compute list of splits
-            sim_splits = [d+'/obs_split%dof%d.fits' % (i+1, self.nsplits)
-                          for i in range(self.nsplits)]
+        if self.is_map_main() and (self.rank==0):
+            # Compute all possible cross-power spectra
+            print("Computing all cross-correlations")
+            cell_data = self.compute_cells_from_splits(splits)
+
+            # Save output
+            print("Saving to file")
+            self.save_cell_to_file(cell_data,
+                                   self.tracers,
+                                   self.bin_win,
+                                   self.get_output('cells_all_splits'))
+
+            # Write all output file names into a text file
+            nsims = len(self.read_map_items(self.get_input('sims_list')))
+            self.write_map_output([self.get_fname_sim(isim) for isim in range(nsims)])
+
+        # Iterate over simulations (all of them, unless the
+        # pipeline is running each one as a separate task). Under MPI,
+        # each process computes and saves its share of them.
+        sims = self.map_items()
+        for i_done,(isim,d) in enumerate(self.split_tasks_by_rank(sims)):
+            print("%d-th / %d simulation" % (i_done+1, len(sims)))
             #   Compute all possible cross-power spectra
-            cell_sim=self.compute_cells_from_splits(sim_splits)
+            cell_sim=self.compute_cells_from_splits(self.get_sim_splits(d))
             #   Save output
-            fname=prefix_out + "_sim%d.sacc" % isim
             self.save_cell_to_file(cell_sim,
                                    self.tracers,
                                    self.bin_nowin,
-                                   fname)
+                                   self.get_fname_sim(isim))
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
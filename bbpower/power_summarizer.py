@@ -1,10 +1,19 @@
 from bbpipe import PipelineStage
 from .types import TextFile, SACCFile,DirFile
+from .windows import compress_window, expand_window, windows_lmax
+from .gaussian import effective_fsky, bandpower_modes, draw_sample_covariances
+from .partial_sky import read_maps
 import sacc
 import numpy as np
 import os
 
 class BBPowerSummarizer(PipelineStage):
+    """
+    Coadds the power spectra of all splits, computes null spectra and
+    noise bias estimates, and their covariances from simulations (or
+    from fast mocks). The apodized masks (the masks_file option) are only
+    read to generate fast mocks.
+    """
     name="BBPowerSummarizer"
     inputs=[('splits_list',TextFile),('bandpasses_list',TextFile),('cells_fiducial',SACCFile),
             ('cells_all_splits',SACCFile),('cells_all_sims',TextFile)]
@@ -13,7 +22,45 @@ class BBPowerSummarizer(PipelineStage):
     config_options={'nulls_covar_type':'diagonal',
                     'nulls_covar_diag_order': 0,
                     'data_covar_type':'block_diagonal',
-                    'data_covar_diag_order': 3}
+                    'data_covar_diag_order': 3,
+                    'fast_mocks': 0,
+                    'fast_mocks_seed': None,
+                    'masks_file': None}
+    # Rough cost model (see estimate_resources)
+    cost_coefficients={'delta_ell':10,       # bandpower width, if bpw_edges isn't given
+                       'read_time':2e-7,     # s per element of each simulated data vector
+                       'covar_time':1e-9,    # s per nsims*ndata^2 for each covariance
+                       'mock_time':1e-9,     # s per nsims*n_bpws*nmaps^3 for fast mocks
+                       'base_memory':5e8}
+
+    @classmethod
+    def estimate_resources(cls, config, files, coefficients):
+        # Reading the simulations scales with their number times the size
+        # of their data vectors, and computing the covariances of the
+        # coadded power spectra with nsims*ndata^2
+        from .costs import n_bandpowers
+        c = coefficients
+        nside = config.get('nside')
+        nbands = cls.count_items(files.get('bandpasses_list'))
+        nsplits = cls.count_items(files.get('splits_list'))
+        nsims = config.get('fast_mocks') or cls.count_items(files.get('cells_all_sims'))
+        if nsims is None:
+            nsims = cls.count_items(files.get('sims_list'))
+        if None in (nside, nbands, nsplits, nsims):
+            return None
+        nbpw = n_bandpowers(nside, config.get('bpw_edges', c['delta_ell']))
+        if nbpw is None:
+            return None
+        nmaps = nbands*nsplits
+        ndata = 4*nbpw*(nmaps*(nmaps+1))//2
+        ncoadd = 4*nbpw*(nbands*(nbands+1))//2
+        if config.get('fast_mocks'):
+            cpu_time = nsims*nbpw*(2*nmaps)**3*c['mock_time']
+        else:
+            cpu_time = nsims*ndata*c['read_time']
+        cpu_time += 3*nsims*ncoadd**2*c['covar_time']
+        memory = c['base_memory'] + 8*nsims*(ndata+3*ncoadd) + 3*8*ncoadd**2
+        return {'cpu_time':cpu_time, 'memory':memory, 'max_nprocess':1}
     
     def get_covariance_from_samples(self,v,covar_type='dense',
                                     off_diagonal_cut=0):
@@ -88,14 +135,16 @@ class BBPowerSummarizer(PipelineStage):
         self.s_splits=sacc.SACC.loadFromHDF(self.get_input('cells_all_splits'))
         # Read sorting and number of bandpowers
         self.check_sacc_consistency(self.s_splits)
+        # Polarization indices and names
+        self.index_pol={'E':0,'B':1}
+        self.pol_names=['E','B']
+
+    def read_sims_list(self):
         # Read file names for the power spectra of all simulations
         with open(self.get_input('cells_all_sims')) as f:
             content=f.readlines()
         self.fname_sims=[x.strip() for x in content]
         self.nsims=len(self.fname_sims)
-        # Polarization indices and names
-        self.index_pol={'E':0,'B':1}
-        self.pol_names=['E','B']
 
     def check_sacc_consistency(self,s):
         """
@@ -162,7 +211,9 @@ class BBPowerSummarizer(PipelineStage):
         if with_windows:
             win_coadd=[]
             win_nulls=[]
-            ls_win = self.s_splits.binning.windows[0].ls.copy()
+            # Windows may only cover part of the multipoles, so they're
+            # evaluated on all multipoles up to the highest one covered
+            ls_win = np.arange(windows_lmax(self.s_splits.binning.windows)+1)
             nls=len(ls_win)
             windows=np.zeros([self.nbands,2,self.nbands,2,self.n_bpws,nls])
             for t1,t2,typ,ells,ndx in self.sorting:
@@ -173,11 +224,20 @@ class BBPowerSummarizer(PipelineStage):
                 p2=self.index_pol[typ[1]]
                 if (s1==0) and (s2==0):
                     for b,i in enumerate(ndx):
-                        w=self.s_splits.binning.windows[i].w
+                        w=expand_window(self.s_splits.binning.windows[i],ls_win)
                         windows[b1,p1,b2,p2,b,:]=w
                         if not ((b1==b2) and (p1==p2)):
                             windows[b2,p2,b1,p1,b,:]=w
 
+            # Output windows only cover the multipoles where they're
+            # non-zero, and each of them is created once
+            windows_sacc={}
+            def get_window(b1,p1,b2,p2,il):
+                key=(b1,p1,b2,p2,il)
+                if key not in windows_sacc:
+                    windows_sacc[key]=compress_window(ls_win,windows[key])
+                return windows_sacc[key]
+
         # Binnings for coadds
         typ, ell, t1, q1, t2, q2 = [], [], [], [], [], []
         for i1 in range(2*self.nbands):
@@ -195,7 +255,7 @@ class BBPowerSummarizer(PipelineStage):
                     q1.append('C')
                     q2.append('C')
                     if with_windows:
-                        win_coadd.append(sacc.Window(ls_win,windows[b1,p1,b2,p2,il]))
+                        win_coadd.append(get_window(b1,p1,b2,p2,il))
         self.bins_coadd=sacc.Binning(typ,ell,t1,q1,t2,q2,windows=win_coadd)
 
         # Binnings for nulls
@@ -216,7 +276,7 @@ class BBPowerSummarizer(PipelineStage):
                                 q1.append('C')
                                 q2.append('C')
                                 if with_windows:
-                                    win_nulls.append(sacc.Window(ls_win,windows[b1,p1,b2,p2,il]))
+                                    win_nulls.append(get_window(b1,p1,b2,p2,il))
         self.bins_nulls=sacc.Binning(typ,ell,t1,q1,t2,q2,windows=win_nulls)
         
     def tracer_number_to_band_split(self,itracer):
@@ -228,19 +288,14 @@ class BBPowerSummarizer(PipelineStage):
         band=itracer//self.nsplits
         return band,split
 
-    def parse_splits_sacc_file(self,s):
+    def get_split_spectra(self,s):
         """
-        Transform a SACC file containing splits into 4 SACC vectors:
-        1 that contains the coadded power spectra.
-        1 that contains coadded power spectra for cross-split only.
-        1 that contains an estimate of the noise power spectrum.
-        1 that contains all null tests
+        Read the power spectra of all splits in a SACC file into an array of
+        form [nsplits,nsplits,nbands,2,nbands,2,n_ell].
         """
-
         # Check we have the right number of bands, splits, cross-correlations and power spectra
         self.check_sacc_consistency(s)
 
-        # Now read power spectra into an array of form [nsplits,nsplits,nbands,nbands,2,2,n_ell]
         # This duplicates the number of elements, but simplifies bookkeeping significantly.
         spectra=np.zeros([self.nsplits,self.nsplits,
                           self.nbands,2,self.nbands,2,
@@ -256,41 +311,153 @@ class BBPowerSummarizer(PipelineStage):
             spectra[s1,s2,b1,p1,b2,p2,:]=s.mean.vector[ndx]
             if is_x:
                 spectra[s2,s1,b2,p2,b1,p1,:]=s.mean.vector[ndx]
+        return spectra
 
+    def coadd_spectra(self,spectra):
+        """
+        Transform the power spectra of all splits (an array of form
+        [...,nsplits,nsplits,nbands,2,nbands,2,n_ell], possibly for
+        several realizations) into 4 data vectors (arrays of form [...,ndata]):
+        1 that contains the coadded power spectra.
+        1 that contains coadded power spectra for cross-split only.
+        1 that contains an estimate of the noise power spectrum.
+        1 that contains all null tests
+        """
         # Coadding (assuming flat coadding)
         # Total coadding (including diagonal)
         weights_total = np.ones(self.nsplits,dtype=float)/self.nsplits
-        spectra_coadd_total = np.einsum('i,ijklmno,j',
+        spectra_coadd_total = np.einsum('i,...ijklmno,j->...klmno',
                                         weights_total,
                                         spectra,
                                         weights_total)
         # Off-diagonal coadding
-        spectra_coadd_xcorr = np.mean(spectra[np.triu_indices(self.nsplits,1)],axis=0)
+        i_x,j_x=np.triu_indices(self.nsplits,1)
+        spectra_coadd_xcorr = np.mean(spectra[...,i_x,j_x,:,:,:,:,:],axis=-6)
 
         # Noise power spectra
         spectra_coadd_noise = spectra_coadd_total - spectra_coadd_xcorr
 
         # Nulls
-        spectra_nulls=np.zeros([self.n_nulls,self.nbands,2,self.nbands,2,self.n_bpws])
-        for i_null,(i,j,k,l) in enumerate(self.pairings):
-            spectra_nulls[i_null]=spectra[i,k]-spectra[i,l]-spectra[j,k]+spectra[j,l]
-            
-        # Turn into SACC means
-        spectra_coadd_total=spectra_coadd_total.reshape([2*self.nbands,2*self.nbands,self.n_bpws])[np.triu_indices(2*self.nbands)]
-        spectra_coadd_xcorr=spectra_coadd_xcorr.reshape([2*self.nbands,2*self.nbands,self.n_bpws])[np.triu_indices(2*self.nbands)]
-        spectra_coadd_noise=spectra_coadd_noise.reshape([2*self.nbands,2*self.nbands,self.n_bpws])[np.triu_indices(2*self.nbands)]
-        spectra_nulls=spectra_nulls.reshape([-1,self.n_bpws])
-        sv_coadd_total=sacc.MeanVec(spectra_coadd_total.flatten())
-        sv_coadd_xcorr=sacc.MeanVec(spectra_coadd_xcorr.flatten())
-        sv_coadd_noise=sacc.MeanVec(spectra_coadd_noise.flatten())
-        sv_nulls=sacc.MeanVec(spectra_nulls.flatten())
-
-        return sv_coadd_total, sv_coadd_xcorr, sv_coadd_noise, sv_nulls
+        i,j,k,l=np.array(self.pairings,dtype=int).reshape([-1,4]).T
+        spectra_nulls=(spectra[...,i,k,:,:,:,:,:]-spectra[...,i,l,:,:,:,:,:]-
+                       spectra[...,j,k,:,:,:,:,:]+spectra[...,j,l,:,:,:,:,:])
+
+        # Turn into data vectors
+        shape=spectra.shape[:-7]
+        iu=np.triu_indices(2*self.nbands)
+        def to_vector(sp):
+            sp=sp.reshape(shape+(2*self.nbands,2*self.nbands,-1))
+            return sp[...,iu[0],iu[1],:].reshape(shape+(-1,))
+        return (to_vector(spectra_coadd_total),to_vector(spectra_coadd_xcorr),
+                to_vector(spectra_coadd_noise),spectra_nulls.reshape(shape+(-1,)))
+
+    def parse_splits_sacc_file(self,s):
+        """
+        Transform a SACC file containing splits into 4 SACC vectors
+        (see coadd_spectra).
+        """
+        vectors=self.coadd_spectra(self.get_split_spectra(s))
+        return tuple(sacc.MeanVec(v) for v in vectors)
+
+    def get_fiducial_spectra(self):
+        """
+        Read the fiducial signal power spectra into an array of form
+        [nbands,2,nbands,2,n_ell].
+        """
+        s=sacc.SACC.loadFromHDF(self.get_input('cells_fiducial'),read_windows=False)
+        if len(s.tracers)!=self.nbands:
+            raise ValueError("Fiducial power spectra have %d bands instead of %d"%
+                             (len(s.tracers),self.nbands))
+        fid=np.zeros([self.nbands,2,self.nbands,2,self.n_bpws])
+        for t1,t2,typ,ells,ndx in s.sortTracers():
+            typ=typ.decode()
+            if (typ[0] not in self.index_pol) or (typ[1] not in self.index_pol):
+                continue
+            if len(ndx)!=self.n_bpws:
+                raise ValueError("Fiducial power spectra have the wrong binning")
+            p1=self.index_pol[typ[0]]
+            p2=self.index_pol[typ[1]]
+            fid[t1,p1,t2,p2,:]=s.mean.vector[ndx]
+            fid[t2,p2,t1,p1,:]=s.mean.vector[ndx]
+        return fid
+
+    def get_model_spectra(self):
+        """
+        Model for the power spectra of all splits, in the form
+        [nsplits,nsplits,nbands,2,nbands,2,n_ell]: the fiducial signal
+        plus a noise bias for auto-split spectra, estimated from the data
+        as the difference between the auto-split and the mean cross-split
+        spectra.
+        """
+        if self.nsplits<2:
+            raise ValueError("At least 2 splits are needed to estimate the noise")
+        spectra=self.get_split_spectra(self.s_splits)
+        i_x,j_x=np.triu_indices(self.nsplits,1)
+        cross=np.mean(spectra[i_x,j_x],axis=0)
+        model=np.zeros_like(spectra)
+        model[:,:]=self.get_fiducial_spectra()
+        for i in range(self.nsplits):
+            model[i,i]+=spectra[i,i]-cross
+        return model
+
+    def get_model_covariance(self):
+        """
+        Model covariance of the harmonic coefficients of all maps (split,
+        band, polarization) in each bandpower: [n_ell,nmaps,nmaps].
+        """
+        nmaps=self.nsplits*self.nbands*2
+        model=self.get_model_spectra()
+        return np.transpose(model,[6,0,2,3,1,4,5]).reshape([self.n_bpws,nmaps,nmaps])
+
+    def get_bandpower_modes(self):
+        """
+        Number of independent modes in each bandpower, given by its window
+        function (which includes the mode coupling computed by
+        BBPowerSpecter) and the mean effective sky fraction of the masks
+        in the masks_file option.
+        """
+        fname=self.config['masks_file']
+        if fname is None:
+            raise ValueError("The masks_file option (the apodized masks used by BBPowerSpecter) "
+                             "is needed to estimate the number of modes in each bandpower")
+        # Use the BB windows of the first map
+        win=None
+        for t1,t2,typ,ells,ndx in self.sorting:
+            if (t1==0) and (t2==0) and (typ.decode()=='BB'):
+                win=[self.s_splits.binning.windows[i] for i in ndx]
+        ls_win=np.arange(windows_lmax(win)+1)
+        win=np.array([expand_window(w,ls_win) for w in win])
+        fsky=np.mean(effective_fsky(read_maps(fname,field=None)))
+        return bandpower_modes(ls_win,win,fsky)
+
+    def get_fast_mocks(self,nmocks):
+        """
+        Draw Gaussian realizations of the power spectra of all splits
+        directly at the bandpower level (see get_model_spectra and
+        get_bandpower_modes), instead of reading those of map-level
+        simulations. Returns the 4 data vectors of all mocks (see
+        coadd_spectra).
+        """
+        nmaps=self.nsplits*self.nbands*2
+        cov=self.get_model_covariance()
+        nu=self.get_bandpower_modes()
+        rng=np.random.default_rng(self.config['fast_mocks_seed'])
+        vectors=[[],[],[],[]]
+        chunk=max(1,20000000//(self.n_bpws*nmaps*nmaps))
+        for i0 in range(0,nmocks,chunk):
+            cl=draw_sample_covariances(cov,nu,min(chunk,nmocks-i0),rng)
+            cl=cl.reshape((-1,self.n_bpws,self.nsplits,self.nbands,2,
+                           self.nsplits,self.nbands,2))
+            cl=np.transpose(cl,[0,2,5,3,4,6,7,1])
+            for v,vc in zip(vectors,self.coadd_spectra(cl)):
+                v.append(vc)
+        return [np.concatenate(v,axis=0) for v in vectors]
 
     def run(self):
         # Set things up
         print("Init")
-        self.init_params()        
+        self.init_params()
+        self.read_sims_list()
 
         # Create tracers for all future files
         print("Tracers")
@@ -304,20 +471,25 @@ class BBPowerSummarizer(PipelineStage):
         print("Reading data")
         sv_cd_t, sv_cd_x, sv_cd_n, sv_null=self.parse_splits_sacc_file(self.s_splits)
         
-        # Read simulations
-        print("Reading simulations")
-        sim_cd_t=np.zeros([self.nsims,len(sv_cd_t.vector)])
-        sim_cd_x=np.zeros([self.nsims,len(sv_cd_x.vector)])
-        sim_cd_n=np.zeros([self.nsims,len(sv_cd_n.vector)])
-        sim_null=np.zeros([self.nsims,len(sv_null.vector)])
-        for i,fn in enumerate(self.fname_sims):
-            print(fn)
-            s=sacc.SACC.loadFromHDF(fn)
-            cd_t,cd_x,cd_n,null=self.parse_splits_sacc_file(s)
-            sim_cd_t[i,:]=cd_t.vector
-            sim_cd_x[i,:]=cd_x.vector
-            sim_cd_n[i,:]=cd_n.vector
-            sim_null[i,:]=null.vector
+        if self.config['fast_mocks']:
+            # Draw simulations
+            print("Generating %d fast mocks"%(self.config['fast_mocks']))
+            sim_cd_t,sim_cd_x,sim_cd_n,sim_null=self.get_fast_mocks(self.config['fast_mocks'])
+        else:
+            # Read simulations
+            print("Reading simulations")
+            sim_cd_t=np.zeros([self.nsims,len(sv_cd_t.vector)])
+            sim_cd_x=np.zeros([self.nsims,len(sv_cd_x.vector)])
+            sim_cd_n=np.zeros([self.nsims,len(sv_cd_n.vector)])
+            sim_null=np.zeros([self.nsims,len(sv_null.vector)])
+            for i,fn in enumerate(self.fname_sims):
+                print(fn)
+                s=sacc.SACC.loadFromHDF(fn)
+                cd_t,cd_x,cd_n,null=self.parse_splits_sacc_file(s)
+                sim_cd_t[i,:]=cd_t.vector
+                sim_cd_x[i,:]=cd_x.vector
+                sim_cd_n[i,:]=cd_n.vector
+                sim_null[i,:]=null.vector
 
         # Compute covariance
         print("Covariances")
@@ -0,0 +1,369 @@
+import numpy as np
+import os
+from contextlib import contextmanager
+
+# The BBCompSep stage being sampled. This is set before any pool of
+# processes is started so that the workers inherit it when forked,
+# since the stage itself (e.g. its sympy-generated functions) can't be
+# pickled. Only the module-level functions below are sent to the pool.
+_compsep = None
+
+
+def lnprob(par):
+    return _compsep.lnprob(par)
+
+
+def lnlike(par):
+    return _compsep.lnlike(par)
+
+
+def prior_transform(u):
+    return _compsep.params.prior_transform(u)
+
+
+class Sampler(object):
+    """
+    Base class for all BBCompSep samplers.
+    Each subclass must define a `name` (used to select it through the
+    `sampler` option of BBCompSep) and a `run` method. Subclasses are
+    automatically registered when defined, so new samplers only need
+    to be imported before BBCompSep runs.
+    All samplers write their results to the `param_chains` npz file,
+    which always contains the names of the free parameters.
+    Checkpoints are not shared: each sampler that can resume a run
+    keeps its own state in a file of its own format next to
+    `param_chains` (see the emcee, zeus and dynesty samplers), which
+    can only be used to resume runs of the same sampler.
+    """
+    samplers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not hasattr(cls, 'name'):
+            raise ValueError("Sampler %s must be given a name" % cls.__name__)
+        if cls.name in cls.samplers:
+            raise ValueError("Sampler %s already defined" % cls.name)
+        cls.samplers[cls.name] = cls
+
+    @classmethod
+    def get_sampler(cls, name):
+        """
+        Return the Sampler subclass with the given name.
+        """
+        try:
+            return cls.samplers[name]
+        except KeyError:
+            raise ValueError("Unknown sampler %s" % name)
+
+    def __init__(self, compsep):
+        self.compsep = compsep
+        self.config = compsep.config
+        self.params = compsep.params
+        self.fname_out = compsep.get_output('param_chains')
+        self.ndim = len(self.params.p0)
+
+    @contextmanager
+    def pool(self):
+        """
+        Context manager returning a pool of `n_pool` processes in which to
+        evaluate the likelihood (or None if `n_pool` <= 1).
+        """
+        global _compsep
+        _compsep = self.compsep
+        n_pool = self.config['n_pool']
+        if n_pool <= 1:
+            yield None
+        else:
+            from multiprocessing import Pool
+            with Pool(n_pool) as pool:
+                yield pool
+
+    def save(self, **kwargs):
+        """
+        Write sampler outputs to the `param_chains` file.
+        """
+        np.savez(self.fname_out,
+                 names=self.params.p_free_names,
+                 **kwargs)
+
+    def report_progress(self, n_iter, n_total, n_done, n_evals, elapsed, tau):
+        print("Iteration %d / %d: %.2lf it/s, %.1lf evals/s, max(tau) = %.1lf" %
+              (n_iter, n_total, n_done / elapsed, n_evals / elapsed, np.amax(tau)))
+
+    def is_converged(self, n_iter, tau, tau_old):
+        """
+        Chains are converged if they are longer than `n_tau_stop`
+        autocorrelation times for all parameters, and the estimate of
+        the autocorrelation time has changed by less than 1%.
+        """
+        n_tau_stop = self.config['n_tau_stop']
+        if n_tau_stop <= 0:
+            return False
+        converged = np.all(n_tau_stop * tau < n_iter)
+        converged &= np.all(np.abs(tau_old - tau) < 0.01 * tau)
+        return converged
+
+    def run(self):
+        raise NotImplementedError("Samplers must implement a run method")
+
+
+class EmceeSampler(Sampler):
+    """
+    Affine-invariant ensemble MCMC (emcee).
+    The chains are checkpointed every `n_checkpoint` iterations (to an
+    emcee HDF5 backend, `param_chains`.h5), and sampling stops early once the chains are longer than `n_tau_stop`
+    times the integrated autocorrelation time of all parameters
+    (and that estimate has stabilized). Set `n_tau_stop` to 0 to
+    always run for `n_iters` iterations.
+    """
+    name = 'emcee'
+
+    def save_chain(self, sampler, tau):
+        self.save(chain=sampler.chain, tau=tau)
+
+    def run(self):
+        import emcee
+        import time
+
+        fname_temp = self.fname_out+'.h5'
+
+        backend = emcee.backends.HDFBackend(fname_temp)
+
+        nwalkers = self.config['nwalkers']
+        n_iters = self.config['n_iters']
+        n_checkpoint = max(self.config['n_checkpoint'], 1)
+        found_file = os.path.isfile(fname_temp)
+
+        if not found_file:
+            backend.reset(nwalkers,self.ndim)
+            pos = [self.params.p0 + 1.e-3*np.random.randn(self.ndim) for i in range(nwalkers)]
+            nsteps_use = n_iters
+        else:
+            print("Restarting from previous run")
+            pos = None
+            nsteps_use = max(n_iters-len(backend.get_chain()), 0)
+
+        with self.pool() as pool:
+            sampler = emcee.EnsembleSampler(nwalkers, self.ndim, lnprob,
+                                            pool=pool, backend=backend)
+            if nsteps_use > 0:
+                if pos is None:
+                    pos = sampler.get_last_sample()
+                tau_old = np.inf
+                n_done = 0
+                start = time.time()
+                for sample in sampler.sample(pos, iterations=nsteps_use, store=True):
+                    n_done += 1
+                    if (sampler.iteration % n_checkpoint) and (n_done < nsteps_use):
+                        continue
+
+                    tau = sampler.get_autocorr_time(tol=0)
+                    self.report_progress(sampler.iteration, n_iters, n_done,
+                                         n_done * nwalkers, time.time() - start, tau)
+                    self.save_chain(sampler, tau)
+                    if self.is_converged(sampler.iteration, tau, tau_old):
+                        print("Chains converged after %d iterations" % sampler.iteration)
+                        break
+                    tau_old = tau
+
+        self.save_chain(sampler, sampler.get_autocorr_time(tol=0))
+        print("Finished sampling")
+
+
+class ZeusSampler(Sampler):
+    """
+    Ensemble slice sampling (zeus).
+    Uses the same checkpointing and convergence criteria as the emcee
+    sampler. The chains are also checkpointed to `param_chains`.zeus.npz,
+    and runs are resumed from the last positions of the walkers stored
+    there.
+    """
+    name = 'zeus'
+
+    def load_checkpoint(self, fname, nwalkers):
+        """
+        Return the chains stored in a checkpoint file, checking that they
+        are compatible with the current run.
+        """
+        chain = np.load(fname)['chain']
+        if chain.ndim != 3 or chain.shape[0] != nwalkers or chain.shape[2] != self.ndim:
+            raise ValueError("Chains in %s have shape %s, expected [%d, n, %d]. "
+                             "Remove the file to start a new run" %
+                             (fname, str(chain.shape), nwalkers, self.ndim))
+        return chain
+
+    def run(self):
+        import zeus
+        import time
+
+        nwalkers = self.config['nwalkers']
+        n_iters = self.config['n_iters']
+        n_checkpoint = max(self.config['n_checkpoint'], 1)
+        fname_temp = self.fname_out+'.zeus.npz'
+
+        # Chains are stored as [nwalkers, nsteps, ndim]
+        if os.path.isfile(fname_temp):
+            print("Restarting from previous run")
+            chain_old = self.load_checkpoint(fname_temp, nwalkers)
+            pos = chain_old[:, -1, :]
+        else:
+            chain_old = np.zeros([nwalkers, 0, self.ndim])
+            pos = np.array([self.params.p0 + 1.e-3*np.random.randn(self.ndim)
+                            for i in range(nwalkers)])
+        n_old = chain_old.shape[1]
+        nsteps_use = max(n_iters-n_old, 0)
+
+        def get_chain(sampler):
+            if nsteps_use == 0:
+                return chain_old
+            chain = np.transpose(sampler.get_chain(), axes=[1, 0, 2])
+            return np.concatenate([chain_old, chain], axis=1)
+
+        def get_tau(chain):
+            return zeus.AutoCorrTime(np.transpose(chain, axes=[1, 0, 2]))
+
+        with self.pool() as pool:
+            sampler = zeus.EnsembleSampler(nwalkers, self.ndim, lnprob,
+                                           pool=pool, verbose=False)
+            if nsteps_use > 0:
+                tau_old = np.inf
+                start = time.time()
+                for n_done, sample in enumerate(sampler.sample(pos, iterations=nsteps_use,
+                                                               progress=False), start=1):
+                    n_iter = n_old + n_done
+                    if (n_iter % n_checkpoint) and (n_done < nsteps_use):
+                        continue
+
+                    chain = get_chain(sampler)
+                    tau = get_tau(chain)
+                    self.report_progress(n_iter, n_iters, n_done,
+                                         sampler.ncall, time.time() - start, tau)
+                    self.save(chain=chain, tau=tau)
+                    np.savez(fname_temp, chain=chain)
+                    if self.is_converged(n_iter, tau, tau_old):
+                        print("Chains converged after %d iterations" % n_iter)
+                        break
+                    tau_old = tau
+
+        chain = get_chain(sampler)
+        self.save(chain=chain, tau=get_tau(chain))
+        print("Finished sampling")
+
+
+class DynestySampler(Sampler):
+    """
+    Nested sampling (dynesty).
+    All free parameters must have proper priors (i.e. top-hat priors
+    must have finite edges). The sampler state is checkpointed every
+    `checkpoint_time` seconds (with dynesty's own format, to
+    `param_chains`.dynesty) and runs are resumed from it.
+    The output contains equal-weight posterior samples in `chain`
+    (as a single walker), as well as the weighted samples and the
+    evidence estimate.
+    """
+    name = 'dynesty'
+
+    def run(self):
+        import dynesty
+
+        fname_temp = self.fname_out+'.dynesty'
+        nlive = self.config['nlive']
+        dlogz = self.config['dlogz']
+        checkpoint_time = self.config['checkpoint_time']
+
+        # Check the priors before starting
+        self.params.prior_transform(0.5*np.ones(self.ndim))
+
+        with self.pool() as pool:
+            queue_size = None if pool is None else self.config['n_pool']
+            if os.path.isfile(fname_temp):
+                print("Restarting from previous run")
+                sampler = dynesty.NestedSampler.restore(fname_temp, pool=pool)
+                sampler.run_nested(resume=True, dlogz=dlogz, checkpoint_file=fname_temp,
+                                   checkpoint_every=checkpoint_time)
+            else:
+                sampler = dynesty.NestedSampler(lnlike, prior_transform, self.ndim,
+                                                nlive=nlive, pool=pool,
+                                                queue_size=queue_size)
+                sampler.run_nested(dlogz=dlogz, checkpoint_file=fname_temp,
+                                   checkpoint_every=checkpoint_time)
+
+        res = sampler.results
+        samples = res.samples_equal()
+        self.save(chain=samples[None, :, :],
+                  samples=res.samples,
+                  weights=res.importance_weights(),
+                  logz=res.logz[-1],
+                  logzerr=res.logzerr[-1])
+        print("Finished sampling")
+        print("log(Z) = %.3lf +- %.3lf" % (res.logz[-1], res.logzerr[-1]))
+
+
+class FisherSampler(Sampler):
+    """
+    Evaluate Fisher matrix
+    """
+    name = 'fisher'
+
+    def run(self):
+        import numdifftools as nd
+        def lnprobd(p):
+            l = self.compsep.lnprob(p)
+            if l == -np.inf:
+                l = -1E100
+            return l
+        fisher = - nd.Hessian(lnprobd)(self.params.p0)
+        cov = np.linalg.inv(fisher)
+        for i,(n,p) in enumerate(zip(self.params.p_free_names,
+                                     self.params.p0)):
+            print(n+" = %.3lE +- %.3lE" % (p, np.sqrt(cov[i, i])))
+        self.save(fisher=fisher)
+
+
+class MaximumLikelihoodSampler(Sampler):
+    """
+    Find maximum likelihood
+    """
+    name = 'maximum_likelihood'
+
+    def run(self):
+        from scipy.optimize import minimize
+        def chi2(par):
+            c2=-2*self.compsep.lnprob(par)
+            return c2
+        res=minimize(chi2, self.params.p0, method="Powell")
+        chi2 = -2*self.compsep.lnprob(res.x)
+        self.save(params=res.x, chi2=chi2)
+        print("Best fit:")
+        for n,p in zip(self.params.p_free_names,res.x):
+            print(n+" = %.3lE" % p)
+        print("Chi2: %.3lE" % chi2)
+
+
+class SinglePointSampler(Sampler):
+    """
+    Evaluate at a single point
+    """
+    name = 'single_point'
+
+    def run(self):
+        chi2 = -2*self.compsep.lnprob(self.params.p0)
+        self.save(chi2=chi2)
+        print("Chi^2:",chi2)
+
+
+class TimingSampler(Sampler):
+    """
+    Evaluate n times and benchmark
+    """
+    name = 'timing'
+
+    def run(self, n_eval=300):
+        import time
+        start = time.time()
+        for i in range(n_eval):
+            self.compsep.lnprob(self.params.p0)
+        end = time.time()
+        self.save(timing=(end-start)/n_eval)
+        print("Total time:",end-start)
+        print("Time per eval:",(end-start)/n_eval)
@@ -0,0 +1,34 @@
+import numpy as np
+import sacc
+
+
+def compress_window(ls, w):
+    """
+    Return a sacc.Window with only the range of multipoles where the
+    window `w` (sampled at multipoles `ls`) is non-zero.
+    """
+    nonzero = np.flatnonzero(w)
+    if len(nonzero) == 0:
+        nonzero = [0]
+    i0, i1 = nonzero[0], nonzero[-1]+1
+    return sacc.Window(ls[i0:i1], w[i0:i1])
+
+
+def windows_lmax(windows):
+    """
+    Return the largest multipole covered by a list of sacc.Windows.
+    """
+    return max(int(np.max(win.ls)) for win in windows)
+
+
+def expand_window(window, ls):
+    """
+    Evaluate a sacc.Window (which may only cover part of the multipoles)
+    at the increasing multipoles `ls`, with zeros outside its range.
+    """
+    w = np.zeros(len(ls))
+    idx = np.searchsorted(ls, window.ls)
+    good = idx < len(ls)
+    good[good] = ls[idx[good]] == window.ls[good]
+    w[idx[good]] = window.w[good]
+    return w
@@ -0,0 +1,68 @@
+import numpy as np
+import healpy as hp
+import pymaster as nmt
+import time
+import sys
+from bbpower.mask_preproc import (distance_to_edges, distance_to_sources,
+                                  apodize, apodization_range)
+
+# Compares the mask apodization and point-source masking of BBMaskPreproc
+# with NaMaster's (as used in generate_apodized_mask.py), with holes made
+# by calling query_disc for each source.
+#
+# Edges should agree to rounding errors. Sources won't: BBMaskPreproc
+# apodizes from the edge of each source disc, while NaMaster apodizes
+# from the pixels whose centres fall inside it (none for sources smaller
+# than a pixel), so they differ by O(1) around sources not much larger
+# than a pixel.
+# NaMaster also refuses apodization scales of less than ~1.5 pixels
+# (e.g. aposize_srcs=0.1 at nside=512).
+if len(sys.argv) not in [3,4]:
+    print("Usage: benchmark_mask_apodization.py nside nsources [aposize_srcs]")
+    exit(1)
+
+nside=int(sys.argv[1])
+nsources=int(sys.argv[2])
+APOSIZE_EDGES=1.
+APOSIZE_SRCS=float(sys.argv[3]) if len(sys.argv)==4 else 0.1
+SIZE_SRCS=2. # arcmin
+APOTYPE='C1'
+
+# Footprint: a cap with fsky=0.1
+npix=hp.nside2npix(nside)
+x,y,z=hp.pix2vec(nside,np.arange(npix))
+mask=np.zeros(npix); mask[z>0.8]=1
+del x,y,z
+
+# Sources inside the footprint
+rng=np.random.default_rng(1234)
+ra=rng.uniform(0,360,nsources)
+dec=np.degrees(np.arcsin(rng.uniform(0.8,1,nsources)))
+size=np.full(nsources,SIZE_SRCS)
+
+print("nside=%d, %d sources" % (nside, nsources))
+start=time.time()
+aposize=np.radians(APOSIZE_EDGES)
+dist=distance_to_edges(mask,apodization_range(aposize,APOTYPE))
+window_edges=apodize(dist,aposize,APOTYPE,nside)
+time_edges=time.time()-start
+start=time.time()
+aposize=np.radians(APOSIZE_SRCS)
+dist=distance_to_sources(mask,ra,dec,size/60.,apodization_range(aposize,APOTYPE))
+window_srcs=apodize(dist,aposize,APOTYPE,nside)
+time_srcs=time.time()-start
+print(" BBMaskPreproc: %.1f s (edges), %.1f s (sources)" % (time_edges, time_srcs))
+
+start=time.time()
+window_edges_nmt=nmt.mask_apodization(mask,APOSIZE_EDGES,apotype=APOTYPE)
+time_edges=time.time()-start
+start=time.time()
+holes=np.ones(npix)
+for r,d,s in zip(ra,dec,size):
+    holes[hp.query_disc(nside,hp.ang2vec(r,d,lonlat=True),np.radians(s/60.))]=0
+window_srcs_nmt=nmt.mask_apodization(holes,APOSIZE_SRCS,apotype=APOTYPE)
+time_srcs=time.time()-start
+print(" NaMaster + query_disc: %.1f s (edges), %.1f s (sources)" % (time_edges, time_srcs))
+print(" Max. difference: %.2E (edges), %.2E (sources)" %
+      (np.amax(np.fabs(window_edges-window_edges_nmt)),
+       np.amax(np.fabs(mask*(window_srcs-window_srcs_nmt)))))
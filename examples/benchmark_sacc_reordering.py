@@ -0,0 +1,69 @@
+import numpy as np
+import time
+
+# Benchmarks the reordering of SACC data/covariances into the
+# [n_bpws, ncross] ordering used by BBCompSep, comparing the
+# pair-by-pair loop with a single index array.
+npol = 2
+n_bpws = 10
+pols = ['E', 'B']
+
+
+def get_order(nfreqs):
+    # Mimics SACC.sortTracers for a coadded file
+    order = []
+    i_d = 0
+    for i1 in range(nfreqs*npol):
+        for i2 in range(i1, nfreqs*npol):
+            typ = (pols[i1 % npol]+pols[i2 % npol]).encode()
+            order.append((i1//npol, i2//npol, typ, np.arange(n_bpws),
+                          np.arange(i_d, i_d+n_bpws)))
+            i_d += n_bpws
+    return order
+
+
+def get_vector_indices(nmaps):
+    ncross = (nmaps*(nmaps+1))//2
+    ind = np.zeros([nmaps, nmaps], dtype=int)
+    ind[np.triu_indices(nmaps)] = np.arange(ncross)
+    return ind + ind.T - np.diag(ind.diagonal())
+
+
+def reorder_loop(order, vind, cv, ncross):
+    cv2d = np.zeros([n_bpws, ncross, n_bpws, ncross])
+    for t1, t2, typ, ells, ndx in order:
+        p1, p2 = typ.decode()
+        iv = vind[t1*npol+pols.index(p1), t2*npol+pols.index(p2)]
+        for t1b, t2b, typb, ellsb, ndxb in order:
+            p1b, p2b = typb.decode()
+            ivb = vind[t1b*npol+pols.index(p1b), t2b*npol+pols.index(p2b)]
+            cv2d[:, iv, :, ivb] = cv[ndx, :][:, ndxb]
+    return cv2d.reshape([n_bpws*ncross, n_bpws*ncross])
+
+
+def reorder_indices(order, vind, cv, ncross):
+    indices = np.zeros([n_bpws, ncross], dtype=int)
+    for t1, t2, typ, ells, ndx in order:
+        p1, p2 = typ.decode()
+        iv = vind[t1*npol+pols.index(p1), t2*npol+pols.index(p2)]
+        indices[:, iv] = ndx
+    ndx_all = indices.flatten()
+    return cv[np.ix_(ndx_all, ndx_all)]
+
+
+for nfreqs in [6, 12]:
+    nmaps = nfreqs*npol
+    ncross = (nmaps*(nmaps+1))//2
+    order = get_order(nfreqs)
+    vind = get_vector_indices(nmaps)
+    cv = np.random.randn(n_bpws*ncross, n_bpws*ncross)
+
+    t0 = time.time()
+    c_loop = reorder_loop(order, vind, cv, ncross)
+    t1 = time.time()
+    c_ind = reorder_indices(order, vind, cv, ncross)
+    t2 = time.time()
+    if not np.array_equal(c_loop, c_ind):
+        raise ValueError("Reordered covariances differ")
+    print("%d frequencies (%d crosses): loop %.3lf s, indices %.3lf s" %
+          (nfreqs, ncross, t1-t0, t2-t1))